@@ -1,8 +1,17 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash
+from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, Response
 import os
-import subprocess
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from spotify_client import SpotifyClient
+from results_cache import ResultsCache
+from downloader import DownloadExecutor, COMPLETED, TIMED_OUT, CANCELLED, OUTPUT_DIR, song_display_name
+from library_index import LibraryIndex
+from job_queue import JobQueue
+from state_store import StateStore
+from dedup import TrackDeduplicator
+import metrics
 
 load_dotenv()
 
@@ -12,23 +21,81 @@ app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev")
 # Inizializza il client Spotify una sola volta
 spotify_client = SpotifyClient(os.getenv("CLIENT_ID"), os.getenv("CLIENT_SECRET"))
 
-# Cache per i risultati
-results_cache = {}
+# Esecutore condiviso per i processi spotdl
+download_executor = DownloadExecutor(cookie_file="/app/cookies.txt")
+
+# Cache per i risultati, condivisa tra i worker e limitata in dimensione
+results_cache = ResultsCache()
+
+# Precaricamento in background delle tracklist dopo una ricerca
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+# Album accettati da una sola richiesta a /tracks
+MAX_TRACKLISTS_PER_REQUEST = 50
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+_prefetches = {}
+_prefetches_lock = threading.Lock()
+
+# Indice dei brani gia' presenti in libreria; la scansione iniziale gira in background
+library_index = LibraryIndex(music_dir=OUTPUT_DIR)
+threading.Thread(target=library_index.scan, daemon=True).start()
+
+# Stato della scoperta condiviso con il container discover
+state_store = StateStore()
 
 def add_to_seed_list(artist_id):
-    """Aggiunge un ID artista al file seed, evitando duplicati."""
-    file_path = 'seed_artists.txt'
+    """Aggiunge un ID artista ai seed, evitando duplicati."""
     try:
-        existing_ids = set()
-        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-            with open(file_path, 'r') as f:
-                existing_ids = {line.strip() for line in f}
-        
-        if artist_id not in existing_ids:
-            with open(file_path, 'a') as f:
-                f.write(f"{artist_id}\n")
+        state_store.add_seed(artist_id)
+    except Exception as e:
+        print(f"Errore durante l'aggiunta ai seed: {e}")
+
+def _load_tracklists(artist_id, album_ids):
+    """Tracklist ({album_id: tracce}) dalla cache dei risultati; le mancanti in blocco dall'API."""
+    tracklists = results_cache.get_tracks(artist_id, album_ids) if artist_id else {}
+    missing = [album_id for album_id in album_ids if album_id not in tracklists]
+    if missing:
+        fetched = {
+            album['id']: album.get('tracks', {}).get('items', [])
+            for album in spotify_client.get_albums_bulk(missing)
+        }
+        if artist_id:
+            results_cache.put_tracks(artist_id, fetched)
+        tracklists.update(fetched)
+    return tracklists
+
+def _prefetch_tracklists(artist_id, album_ids):
+    try:
+        _load_tracklists(artist_id, album_ids)
     except Exception as e:
-        print(f"Errore durante l'aggiunta al file seed: {e}")
+        print(f"Errore nel precaricamento delle tracce di {artist_id}: {e}")
+    finally:
+        with _prefetches_lock:
+            _prefetches.pop(artist_id, None)
+
+def prefetch_tracklists(artist_id, album_ids):
+    """Avvia in background il caricamento delle tracklist dei risultati di una ricerca."""
+    with _prefetches_lock:
+        if artist_id in _prefetches:
+            return
+        _prefetches[artist_id] = prefetch_executor.submit(_prefetch_tracklists, artist_id, album_ids)
+
+def album_tracklists(artist_id, album_ids):
+    """
+    Tracklist degli album indicati. Se il precaricamento dello stesso artista
+    e' in corso lo aspetta, invece di ripetere le stesse chiamate all'API.
+    """
+    with _prefetches_lock:
+        prefetch = _prefetches.get(artist_id)
+    if prefetch:
+        prefetch.result()
+    return _load_tracklists(artist_id, album_ids)
+
+def _track_details(tracks):
+    return [{
+        'id': track.get('id'),
+        'name': track.get('name'),
+        'url': track.get('external_urls', {}).get('spotify')
+    } for track in tracks]
 
 @app.route('/')
 def index():
@@ -49,96 +116,116 @@ def search():
     if albums is None:
         return "Errore nel recuperare gli album.", 500
 
-    album_details = []
-    seen_albums = set()
-    for album in albums:
-        album_name = album.get('name')
-        if album_name.lower() not in seen_albums:
-            album_details.append({
-                'id': album.get('id'),
-                'name': album_name,
-                'url': album.get('external_urls', {}).get('spotify'),
-                'image_url': album.get('images', [{}])[0].get('url') if album.get('images') else ''
-            })
-            seen_albums.add(album_name.lower())
+    # get_artist_albums tiene gia' una sola edizione per release
+    album_details = [{
+        'id': album.get('id'),
+        'name': album.get('name'),
+        'url': album.get('external_urls', {}).get('spotify'),
+        'image_url': album.get('images', [{}])[0].get('url') if album.get('images') else ''
+    } for album in albums]
     
     album_details.sort(key=lambda x: x['name'])
     
-    results_cache[artist_id] = {
-        'artist_name': artist_name,
-        'albums': album_details
-    }
+    results_cache.put(artist_id, artist_name, album_details)
+    # Le tracklist arrivano in cache mentre l'utente guarda la pagina
+    prefetch_tracklists(artist_id, [album['id'] for album in album_details])
 
     return render_template('results.html', artist_name=artist_name, albums=album_details, artist_id=artist_id)
 
 @app.route('/tracks/<album_id>')
 def get_tracks(album_id):
-    tracks = spotify_client.get_album_tracks(album_id)
+    tracks = album_tracklists(request.args.get('artist_id'), [album_id]).get(album_id)
 
     if tracks is None:
         return jsonify({'error': 'Errore nel recuperare le tracce'}), 500
 
-    track_details = [{
-        'id': track.get('id'),
-        'name': track.get('name'),
-        'url': track.get('external_urls', {}).get('spotify')
-    } for track in tracks]
-    
-    return jsonify(track_details)
+    return jsonify(_track_details(tracks))
 
-# --- Download e Stato ---
-download_status = {
-    'progress': 0,
-    'status_messages': [],
-    'total_items': 0,
-    'completed_items': 0,
-}
+@app.route('/tracks')
+def get_tracks_batch():
+    """Tracce di piu' album in una risposta: /tracks?artist_id=...&ids=id1,id2 -> {album_id: tracce}."""
+    album_ids = [album_id for album_id in request.args.get('ids', '').split(',') if album_id]
+    if not album_ids:
+        return jsonify({'error': 'Nessun album indicato'}), 400
+    if len(album_ids) > MAX_TRACKLISTS_PER_REQUEST:
+        return jsonify({'error': f"Al massimo {MAX_TRACKLISTS_PER_REQUEST} album per richiesta"}), 400
 
-def run_download(items_to_download):
-    """Esegue il download in un thread separato."""
-    global download_status
+    tracklists = album_tracklists(request.args.get('artist_id'), album_ids)
+    return jsonify({album_id: _track_details(tracks) for album_id, tracks in tracklists.items()})
+
+# --- Download e Stato ---
+def run_download(queue, job):
+    """Esegue un job della coda, con piu' processi spotdl in parallelo."""
+    log = job.status_messages
+    items_to_download = job.pending_items
 
     if not items_to_download:
-        download_status['progress'] = 100
-        download_status['status_messages'].append("Nessun elemento valido da scaricare.")
+        log.append("Nessun nuovo elemento da scaricare.")
         return
 
-    output_dir = "/app/music"
-    cookie_file = "/app/cookies.txt" 
-
-    for i, (item_type, item_name, item_url) in enumerate(items_to_download):
-        download_status['status_messages'].append(f"-> Inizio download {item_type}: {item_name}")
-        
-        command = ['spotdl', item_url, '--format', 'opus', '--output', output_dir]
-        if cookie_file and os.path.exists(cookie_file):
-            command.extend(['--cookie-file', cookie_file])
-
-        try:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8', bufsize=1)
-            
-            for line in iter(process.stdout.readline, ''):
-                if line:
-                    download_status['status_messages'].append(f"   {line.strip()}")
-            
-            process.wait(timeout=180)
-
-            if process.returncode == 0:
-                download_status['status_messages'].append(f"   Download di '{item_name}' completato con successo.")
-            else:
-                download_status['status_messages'].append(f"   ERRORE durante il download di '{item_name}'. Codice: {process.returncode}")
-
-        except subprocess.TimeoutExpired:
-            process.kill()
-            download_status['status_messages'].append(f"   ERRORE: Timeout (3 minuti) superato per '{item_name}'. Download interrotto e saltato.")
-        except Exception as e:
-            download_status['status_messages'].append(f"   ERRORE CRITICO per '{item_name}': {e}")
-            
-        download_status['completed_items'] = i + 1
-        download_status['progress'] = int((download_status['completed_items'] / download_status['total_items']) * 100)
-
-    download_status['status_messages'].append("--- TUTTI I DOWNLOAD SONO TERMINATI ---")
-    if download_status['completed_items'] == download_status['total_items']:
-        download_status['progress'] = 100
+    track_ids_by_url = {item_url: track_ids for _, _, item_url, track_ids in items_to_download}
+
+    def on_output(download_job, line):
+        log.append(f"   [{download_job.name}] {line}")
+
+    def on_done(download_job):
+        library_index.mark_downloaded([
+            track_id
+            for _, url in download_job.items if download_job.results.get(url) == COMPLETED
+            for track_id in track_ids_by_url.get(url, [])
+        ])
+        if len(download_job.items) > 1:
+            for name, url in download_job.items:
+                if download_job.results.get(url) != COMPLETED:
+                    log.append(f"   ERRORE durante il download di '{name}'.")
+        if download_job.status == COMPLETED:
+            log.append(f"   Download di '{download_job.name}' completato con successo.")
+        elif download_job.status == TIMED_OUT:
+            log.append(f"   ERRORE: Timeout ({download_executor.timeout}s) superato per '{download_job.name}'. Download interrotto e saltato.")
+        elif download_job.status == CANCELLED:
+            log.append(f"   Download di '{download_job.name}' annullato.")
+            # Gli elementi annullati non contano come completati: non vanno segnati
+            return
+        elif download_job.error:
+            log.append(f"   ERRORE CRITICO per '{download_job.name}': {download_job.error}")
+        else:
+            log.append(f"   ERRORE durante il download di '{download_job.name}'. Codice: {download_job.returncode}")
+        for _, url in download_job.items:
+            queue.item_done(job, url)
+
+    tracks = []
+    for item_type, item_name, item_url, track_ids in items_to_download:
+        if job.cancelled:
+            break
+        log.append(f"-> Inizio download {item_type}: {item_name}")
+        if item_type == 'track':
+            tracks.append((item_name, item_url))
+        else:
+            # Un album e' gia' un batch: spotdl scarica tutte le tracce in un solo processo
+            job.download_jobs.append(download_executor.submit(item_name, item_url, on_output=on_output, on_done=on_done,
+                                                              tracks=len(track_ids)))
+    if tracks and not job.cancelled:
+        job.download_jobs.extend(download_executor.submit_chunked("Tracce selezionate", tracks, on_output=on_output, on_done=on_done))
+    if job.cancelled:
+        # Annullato mentre sottomettevamo: fermiamo anche i job appena creati
+        for download_job in job.download_jobs:
+            download_job.cancel()
+
+    download_executor.wait(job.download_jobs)
+
+    if job.cancelled:
+        log.append("--- DOWNLOAD ANNULLATO ---")
+    else:
+        log.append("--- TUTTI I DOWNLOAD SONO TERMINATI ---")
+
+# Coda persistente dei download: i job interrotti riprendono al riavvio
+job_queue = JobQueue(run_download)
+# Con `python app.py` (debug=True) il reloader di Werkzeug importa il modulo
+# anche nel processo padre, che si limita a sorvegliare i file: i worker
+# partono solo nel processo che serve le richieste
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    job_queue.start()
+metrics.JOBS_QUEUED.set_function(job_queue.count)
 
 @app.route('/download', methods=['POST'])
 def download():
@@ -162,40 +249,63 @@ def download():
         elif item_type == 'track':
             track_ids_to_download.append(item_id)
 
-    if album_ids_to_download:
-        cache = results_cache.get(artist_id)
-        if cache:
-             for album_id in album_ids_to_download:
-                album = next((a for a in cache['albums'] if a['id'] == album_id), None)
-                if album:
-                    items_to_download.append(('album', album['name'], album['url']))
+    # Elementi gia' presenti in libreria, saltati senza avviare spotdl
+    skipped_messages = []
+
+    # Tracklist degli album selezionati: di solito gia' precaricate dalla ricerca
+    selected_albums = [
+        album for album in (results_cache.get_album(artist_id, album_id) for album_id in album_ids_to_download)
+        if album
+    ]
+    tracklists = album_tracklists(artist_id, [album['id'] for album in selected_albums])
+
+    # Le tracce presenti in piu' album selezionati (edizioni, singoli poi
+    # inclusi nell'album) vengono scaricate una sola volta
+    dedup = TrackDeduplicator()
+    for album in selected_albums:
+        album_tracks = tracklists.get(album['id'], [])
+        missing = [
+            track for track in album_tracks
+            if not library_index.has_track(track.get('id')) and dedup.add(track)
+        ]
+        if album_tracks and not missing:
+            skipped_messages.append(f"-> Album '{album['name']}' gia' presente in libreria o in un altro album selezionato. Saltato.")
+        elif album_tracks and len(missing) < len(album_tracks):
+            # Album scaricato in parte: solo le tracce mancanti
+            skipped_messages.append(f"-> Album '{album['name']}': {len(album_tracks) - len(missing)} tracce gia' presenti o duplicate, scarico le altre {len(missing)}.")
+            for track in missing:
+                track_url = track.get('external_urls', {}).get('spotify')
+                if track_url:
+                    items_to_download.append(('track', song_display_name(track), track_url, [track.get('id')]))
+        else:
+            items_to_download.append(('album', album['name'], album['url'], [track.get('id') for track in album_tracks]))
 
     if track_ids_to_download:
         # Recuperiamo i dettagli in blocco
         tracks_data = spotify_client.get_tracks_by_ids(track_ids_to_download)
         for track_data in tracks_data:
             if track_data:
-                track_name = track_data.get('name')
+                track_name = song_display_name(track_data)
                 track_url = track_data.get('external_urls', {}).get('spotify')
-                if track_name and track_url:
-                    items_to_download.append(('track', track_name, track_url))
-
-    if not items_to_download:
+                isrc = track_data.get('external_ids', {}).get('isrc')
+                if library_index.has_track(track_data.get('id'), isrc):
+                    skipped_messages.append(f"-> Traccia '{track_name}' gia' presente in libreria. Saltata.")
+                elif not dedup.add(track_data, isrc):
+                    skipped_messages.append(f"-> Traccia '{track_name}' gia' inclusa nel download. Saltata.")
+                elif track_name and track_url:
+                    items_to_download.append(('track', track_name, track_url, [track_data.get('id')]))
+
+    if not items_to_download and not skipped_messages:
         return "Nessun elemento valido da scaricare.", 400
 
-    global download_status
-    download_status = {
-        'progress': 0,
-        'status_messages': ["Inizializzazione del download..."],
-        'total_items': len(items_to_download),
-        'completed_items': 0,
-    }
-    
-    import threading
-    download_thread = threading.Thread(target=run_download, args=(items_to_download,))
-    download_thread.start()
+    cached_results = results_cache.get(artist_id)
+    title = cached_results['artist_name'] if cached_results else artist_id
+    priority = request.form.get('priority', 0, type=int)
+    job = job_queue.submit(title, items_to_download, priority=priority)
+    for message in skipped_messages:
+        job.status_messages.append(message)
 
-    return redirect(url_for('status_page'))
+    return redirect(url_for('status_page', job=job.id))
 
 @app.route('/update-cookie', methods=['POST'])
 def update_cookie():
@@ -212,13 +322,84 @@ def update_cookie():
         
     return redirect(url_for('index'))
 
+def _status_snapshot(job, cursor):
+    """Stato di un job con i soli messaggi successivi a `cursor`."""
+    messages, cursor, dropped = job.status_messages.since(cursor)
+    return dict(job.to_dict(), status_messages=messages, cursor=cursor, dropped=dropped)
+
+def _requested_job():
+    """Il job indicato dal parametro `job`, o l'ultimo creato."""
+    job_id = request.args.get('job', type=int)
+    return job_queue.get(job_id) if job_id else job_queue.latest()
+
 @app.route('/status')
 def status():
-    return jsonify(download_status)
+    """Stato incrementale: `since` e' il cursore restituito dalla chiamata precedente."""
+    job = _requested_job()
+    if job is None:
+        return jsonify({'error': 'Nessun download trovato'}), 404
+    return jsonify(_status_snapshot(job, request.args.get('since', 0, type=int)))
+
+@app.route('/status/stream')
+def status_stream():
+    """Server-Sent Events: invia solo le nuove righe e le variazioni di progresso."""
+    job = _requested_job()
+    if job is None:
+        return jsonify({'error': 'Nessun download trovato'}), 404
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('since', '0')
+    cursor = int(last_event_id) if last_event_id.isdigit() else 0
+
+    def events():
+        current = cursor
+        last_progress = None
+        while True:
+            snapshot = _status_snapshot(job, current)
+            if snapshot['status_messages'] or snapshot['dropped'] or snapshot['progress'] != last_progress:
+                current = snapshot['cursor']
+                last_progress = snapshot['progress']
+                yield f"id: {current}\ndata: {json.dumps(snapshot)}\n\n"
+            if snapshot['progress'] >= 100:
+                yield "event: done\ndata: {}\n\n"
+                return
+            job.status_messages.wait(current, timeout=15)
+            if job.status_messages.cursor == current and job.progress == last_progress:
+                # Commento SSE per tenere viva la connessione attraverso i proxy
+                yield ": keepalive\n\n"
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/jobs')
+def list_jobs():
+    """Elenco degli ultimi download con il loro stato."""
+    return jsonify([job.to_dict() for job in job_queue.list(request.args.get('limit', 50, type=int))])
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Annulla un download in coda o in corso."""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Download non trovato'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Contatori di hit/miss della cache delle risposte Spotify."""
+    if not spotify_client.cache:
+        return jsonify({'enabled': False})
+    return jsonify(dict(spotify_client.cache.stats(), enabled=True))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Metriche (latenza e tentativi dell'API, durata ed esito dei download, code) in formato Prometheus."""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/status-page')
 def status_page():
-    return render_template('status.html')
+    job = _requested_job()
+    return render_template('status.html', job_id=job.id if job else None, jobs=job_queue.list(20))
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1,152 @@
+import heapq
+from array import array
+
+# Pesi del punteggio di priorita' della frontiera
+POPULARITY_WEIGHT = 1.0
+CONNECTION_WEIGHT = 5.0
+HOP_PENALTY = 15.0
+
+MAX_HOP = 255
+
+class ArtistGraph:
+    """
+    Grafo compatto degli artisti correlati con frontiera a priorita'.
+
+    Ogni artista riceve un indice intero; popolarita', distanza dai seed
+    (hop) e numero di collegamenti entranti stanno in array tipizzati e i
+    vicini di un artista espanso in un array('I'). Cosi' 100k artisti
+    occupano poche decine di MB invece di un dizionario di dizionari.
+
+    La frontiera e' un heap sul punteggio
+        popolarita' * POPULARITY_WEIGHT + (collegamenti - 1) * CONNECTION_WEIGHT - hop * HOP_PENALTY
+    con invalidazione pigra: quando il punteggio di un artista cambia viene
+    inserita una nuova voce e quelle vecchie vengono scartate all'estrazione.
+    Con HOP_PENALTY molto alto la visita diventa una BFS.
+    """
+    def __init__(self, popularity_weight=POPULARITY_WEIGHT, connection_weight=CONNECTION_WEIGHT,
+                 hop_penalty=HOP_PENALTY):
+        self.popularity_weight = popularity_weight
+        self.connection_weight = connection_weight
+        self.hop_penalty = hop_penalty
+        self._index = {}
+        self.ids = []
+        self.popularity = array('B')
+        self.hops = array('B')
+        self.connections = array('I')
+        self.expanded = bytearray()
+        self._neighbors = {}
+        self._heap = []
+        # Nodi estratti con pop() in attesa della risposta dell'API
+        self._claimed = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, artist_id):
+        return artist_id in self._index
+
+    def _node(self, artist_id, hop):
+        node = self._index.get(artist_id)
+        if node is None:
+            node = len(self.ids)
+            self._index[artist_id] = node
+            self.ids.append(artist_id)
+            self.popularity.append(0)
+            self.hops.append(min(hop, MAX_HOP))
+            self.connections.append(0)
+            self.expanded.append(0)
+        elif hop < self.hops[node]:
+            self.hops[node] = hop
+        return node
+
+    def score(self, node):
+        return (self.popularity[node] * self.popularity_weight
+                + max(0, self.connections[node] - 1) * self.connection_weight
+                - self.hops[node] * self.hop_penalty)
+
+    def add(self, artist_id, hop, popularity=0, connections=0, expanded=False):
+        """Aggiunge (o aggiorna) un artista e, se non e' gia' espanso, lo mette in frontiera."""
+        node = self._node(artist_id, hop)
+        self.popularity[node] = max(self.popularity[node], min(int(popularity or 0), 255))
+        self.connections[node] = max(self.connections[node], connections)
+        if expanded:
+            self.expanded[node] = 1
+        else:
+            self._push(node)
+        return node
+
+    def _push(self, node):
+        if not self.expanded[node] and node not in self._claimed:
+            heapq.heappush(self._heap, (-self.score(node), node))
+
+    def add_edges(self, artist_id, related):
+        """
+        Registra i vicini di un artista appena espanso. `related` e' la lista
+        di artisti restituita dall'API. Restituisce gli ID degli artisti nuovi.
+        """
+        source = self._index[artist_id]
+        self.expanded[source] = 1
+        self._claimed.discard(source)
+        hop = self.hops[source] + 1
+        targets = array('I')
+        new_ids = []
+        for artist in related:
+            related_id = artist.get('id')
+            if not related_id:
+                continue
+            is_new = related_id not in self._index
+            node = self._node(related_id, hop)
+            self.popularity[node] = min(int(artist.get('popularity') or 0), 255)
+            self.connections[node] += 1
+            targets.append(node)
+            if is_new:
+                new_ids.append(related_id)
+            self._push(node)
+        self._neighbors[source] = targets
+        return new_ids
+
+    def pop(self, max_depth=None):
+        """
+        Estrae l'artista non espanso con il punteggio piu' alto (o None).
+        Diventa espanso solo con add_edges(), dopo una risposta valida
+        dell'API; se la chiamata fallisce release() lo rimette in frontiera.
+        Gli artisti a distanza `max_depth` restano nel grafo ma non vengono
+        espansi.
+        """
+        while self._heap:
+            neg_score, node = heapq.heappop(self._heap)
+            if self.expanded[node] or node in self._claimed or -neg_score != self.score(node):
+                continue
+            if max_depth is not None and self.hops[node] >= max_depth:
+                continue
+            self._claimed.add(node)
+            return self.ids[node]
+        return None
+
+    def release(self, artist_id, requeue=True):
+        """
+        Annulla il pop() di un artista la cui espansione e' fallita: con
+        requeue torna subito in frontiera, altrimenti resta non espanso
+        (e viene salvato come tale) ma non viene piu' estratto.
+        """
+        node = self._index[artist_id]
+        self._claimed.discard(node)
+        if requeue:
+            self._push(node)
+
+    def neighbors(self, artist_id):
+        node = self._index.get(artist_id)
+        return [self.ids[target] for target in self._neighbors.get(node, ())]
+
+    def info(self, artist_id):
+        """(hop, popolarita', collegamenti, espanso) di un artista."""
+        node = self._index[artist_id]
+        return self.hops[node], self.popularity[node], self.connections[node], bool(self.expanded[node])
+
+    def frontier(self, max_depth=None):
+        """Artisti non ancora espansi (entro `max_depth`), come (id, hop, popolarita', collegamenti)."""
+        return [
+            (self.ids[node], self.hops[node], self.popularity[node], self.connections[node])
+            for node in range(len(self.ids))
+            if not self.expanded[node] and (max_depth is None or self.hops[node] < max_depth)
+        ]
@@ -0,0 +1,71 @@
+import asyncio
+from spotify_client import SpotifyClient, MAX_SEARCH_RESULTS
+
+# Richieste API in volo contemporaneamente per default
+DEFAULT_CONCURRENCY = 8
+
+class AsyncSpotifyClient:
+    """
+    Variante asyncio di SpotifyClient con la stessa interfaccia.
+
+    Ogni chiamata viene eseguita in un thread del loop tramite il client
+    sincrono sottostante, quindi condivide con esso pool di connessioni,
+    token e RateLimiter: il budget di richieste resta unico anche quando
+    client sincrono e asincrono lavorano insieme. Un semaforo limita il
+    numero di richieste in volo.
+    """
+    def __init__(self, client_id=None, client_secret=None, concurrency=DEFAULT_CONCURRENCY, sync_client=None):
+        if sync_client is None:
+            # Il pool deve avere almeno tante connessioni quante richieste in volo
+            sync_client = SpotifyClient(client_id, client_secret, pool_maxsize=concurrency)
+        self.sync_client = sync_client
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    @property
+    def rate_limiter(self):
+        return self.sync_client.rate_limiter
+
+    async def _call(self, method, *args):
+        # Il semaforo appartiene al loop in cui e' stato creato (in Python < 3.10
+        # gia' alla creazione): ogni asyncio.run() che usa il client ne ha uno suo
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._semaphore_loop = loop
+        async with self._semaphore:
+            return await asyncio.to_thread(method, *args)
+
+    async def search_artist(self, artist_name):
+        return await self._call(self.sync_client.search_artist, artist_name)
+
+    async def get_artist_albums(self, artist_id):
+        return await self._call(self.sync_client.get_artist_albums, artist_id)
+
+    async def get_new_artist_albums(self, artist_id, known_album_ids, since_date=None):
+        return await self._call(self.sync_client.get_new_artist_albums, artist_id, known_album_ids, since_date)
+
+    async def get_album_tracks(self, album_id):
+        return await self._call(self.sync_client.get_album_tracks, album_id)
+
+    async def get_related_artists(self, artist_id):
+        return await self._call(self.sync_client.get_related_artists, artist_id)
+
+    async def get_playlist_track_artists(self, playlist_id):
+        return await self._call(self.sync_client.get_playlist_track_artists, playlist_id)
+
+    async def search_for_genre(self, genre, max_results=MAX_SEARCH_RESULTS):
+        return await self._call(self.sync_client.search_for_genre, genre, max_results)
+
+    async def get_tracks_by_ids(self, track_ids):
+        return await self._call(self.sync_client.get_tracks_by_ids, track_ids)
+
+    async def get_albums_bulk(self, album_ids):
+        return await self._call(self.sync_client.get_albums_bulk, album_ids)
+
+    async def get_artists_bulk(self, artist_ids):
+        return await self._call(self.sync_client.get_artists_bulk, artist_ids)
+
+    async def search_playlist(self, playlist_name):
+        return await self._call(self.sync_client.search_playlist, playlist_name)
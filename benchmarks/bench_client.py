@@ -0,0 +1,47 @@
+"""
+Benchmark: espansione di artisti in tracce con SpotifyClient contro lo stub
+(discografia, tracklist in blocco e ISRC, come fa discover.py), senza
+download. Misura quanto costa il lato metadati della pipeline.
+
+Uso:
+    python benchmarks/bench_client.py [--artists 200] [--threads 8] [--latency 0.02] [--throttle-rate 0.01]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from harness import add_stub_arguments, prepare, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--artists', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url, workdir = prepare(args)
+    from spotify_client import SpotifyClient
+    from spotify_stub import artist_id
+
+    client = SpotifyClient('bench-id', 'bench-secret', pool_maxsize=args.threads)
+
+    def expand(n):
+        releases = client.get_artist_albums(artist_id(n))
+        albums = client.get_albums_bulk([release['id'] for release in releases])
+        track_ids = [track['id'] for album in albums for track in album.get('tracks', {}).get('items', [])]
+        return len(client.get_tracks_by_ids(track_ids))
+
+    print(f"{args.artists} artisti, {args.threads} thread, stub su {base_url} (stato in {workdir})")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        tracks = sum(executor.map(expand, range(args.artists)))
+    elapsed = time.perf_counter() - start
+
+    report("SpotifyClient: espansione artisti", elapsed, server, args.artists, tracks)
+    client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark end-to-end di discover.main(): scoperta (generi, classifiche,
+artisti correlati), espansione e download con il finto spotdl, tutto contro
+lo stub locale. Le impostazioni vengono scritte in una cartella temporanea.
+
+Uso:
+    python benchmarks/bench_discover.py [--genres 3] [--playlists 1] [--seeds 2] [--threshold 80]
+                                        [--spotdl-seconds 0.05] [--workers 3] [--latency 0.02]
+"""
+import argparse
+import json
+import os
+import time
+
+from harness import add_spotdl_arguments, add_stub_arguments, prepare, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--genres', type=int, default=3, help="generi seme")
+    parser.add_argument('--playlists', type=int, default=1, help="playlist di classifica")
+    parser.add_argument('--seeds', type=int, default=2, help="artisti seme")
+    parser.add_argument('--threshold', type=int, default=80, help="popolarita' minima degli artisti")
+    parser.add_argument('--crawl', action='store_true', help="usa il crawl multi-hop degli artisti correlati")
+    parser.add_argument('--concurrency', type=int, default=8, help="max_concurrent_requests")
+    add_stub_arguments(parser)
+    add_spotdl_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url, workdir = prepare(args, spotdl=True)
+    os.chdir(workdir)
+    with open('discovery_settings.json', 'w') as f:
+        json.dump({
+            'popularity_threshold_artist': args.threshold,
+            'top_chart_playlists': {f"Classifica {i}": f"classifica-{i}" for i in range(args.playlists)},
+            'seed_genres': [f"genere-{i}" for i in range(args.genres)],
+            'max_concurrent_requests': args.concurrency,
+            'max_parallel_downloads': args.workers,
+            'related_artists_crawl': args.crawl,
+        }, f)
+
+    import discover
+    import metrics
+    from spotify_stub import artist_id
+    from state_store import StateStore
+
+    store = StateStore()
+    for n in range(args.seeds):
+        store.add_seed(artist_id(n))
+    processed_before = store.processed_count() + args.seeds
+
+    print(f"Benchmark discover: stub su {base_url}, stato in {workdir}")
+    start = time.perf_counter()
+    discover.main()
+    elapsed = time.perf_counter() - start
+
+    artists = store.processed_count() - processed_before
+    report("discover.main", elapsed, server, artists, int(metrics.DOWNLOAD_TRACKS.total()))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
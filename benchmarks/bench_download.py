@@ -0,0 +1,59 @@
+"""
+Benchmark end-to-end dell'interfaccia web: per ogni artista una ricerca
+(/search) e il download di tutti i suoi album (/download), eseguito da
+app.run_download attraverso la coda dei job, con il finto spotdl e lo stub.
+
+Uso:
+    python benchmarks/bench_download.py [--artists 10] [--spotdl-seconds 0.05] [--workers 3] [--job-workers 2]
+"""
+import argparse
+import os
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from harness import add_spotdl_arguments, add_stub_arguments, prepare, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--artists', type=int, default=10)
+    parser.add_argument('--job-workers', type=int, default=2, help="JOB_WORKERS dell'app")
+    add_stub_arguments(parser)
+    add_spotdl_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url, workdir = prepare(args, spotdl=True)
+    os.environ['JOB_WORKERS'] = str(args.job_workers)
+    os.chdir(workdir)
+
+    import app
+    from job_queue import FINAL_STATES
+
+    client = app.app.test_client()
+    print(f"Benchmark download web: {args.artists} artisti, stub su {base_url}, stato in {workdir}")
+    start = time.perf_counter()
+    job_ids = []
+    for n in range(args.artists):
+        artist_name = f"Artista {n}"
+        client.post('/search', data={'artist': artist_name})
+        # Stessa ricerca della pagina: la risposta arriva dalla cache, non dallo stub
+        artist_id = app.spotify_client.search_artist(artist_name)['id']
+        albums = app.results_cache.get(artist_id)['albums']
+        response = client.post('/download', data={
+            'artist_id': artist_id,
+            'selected_items': [f"album-{album['id']}" for album in albums],
+        })
+        job_ids.append(int(parse_qs(urlsplit(response.location).query)['job'][0]))
+
+    jobs = [app.job_queue.get(job_id) for job_id in job_ids]
+    while any(job.state not in FINAL_STATES for job in jobs):
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    tracks = sum(len(item[3]) for job in jobs for item in job.items)
+    report("app.run_download (via /search e /download)", elapsed, server, args.artists, tracks)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
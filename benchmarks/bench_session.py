@@ -0,0 +1,68 @@
+"""
+Benchmark: richieste al secondo con requests.get "nudo" (una connessione
+TCP per richiesta) contro il pool keep-alive di SpotifyClient.
+
+Uso:
+    python benchmarks/bench_session.py [--requests 500] [--threads 4]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from spotify_stub import start_stub_server
+
+
+def run(label, fetch, total, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(lambda _: fetch(), range(total)))
+    elapsed = time.perf_counter() - start
+    failures = sum(1 for r in results if not r)
+    print(f"{label:<28} {total / elapsed:10.1f} req/s  ({elapsed:.2f}s, errori: {failures})")
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server()
+    # Gli URL del client sono letti all'import: vanno impostati prima
+    os.environ['SPOTIFY_API_URL'] = f"{base_url}/v1"
+    os.environ['SPOTIFY_AUTH_URL'] = f"{base_url}/api/token"
+    from spotify_client import SpotifyClient, RateLimiter
+
+    url = f"{base_url}/v1/artists/seed/related-artists"
+    headers = {'Authorization': 'Bearer stub-token'}
+
+    def fetch_plain():
+        response = requests.get(url, headers=headers, timeout=10)
+        return response.ok and response.json()
+
+    # Senza cache ne' limite di velocita': si misura solo il trasporto HTTP
+    client = SpotifyClient('bench-id', 'bench-secret', pool_maxsize=args.threads,
+                           rate_limiter=RateLimiter(rate=1e6, burst=args.threads), cache=False)
+
+    def fetch_pooled():
+        return client._make_request(url)
+
+    print(f"{args.requests} richieste, {args.threads} thread, stub su {base_url}")
+    before = run("requests.get (prima)", fetch_plain, args.requests, args.threads)
+    after = run("SpotifyClient pool (dopo)", fetch_pooled, args.requests, args.threads)
+    print(f"Speedup: {after / before:.2f}x")
+
+    client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Finto `spotdl` per i benchmark: non scarica niente, ma si comporta come
+spotdl dal punto di vista di DownloadExecutor: una riga di esito per
+canzone nel formato reale (`Downloaded "Artista - Titolo": ...`), con i nomi
+presi dal catalogo dello stub, e codice di uscita 0. Un URL di album produce
+una riga per ciascuna delle sue tracce.
+
+Variabili d'ambiente:
+    FAKE_SPOTDL_SECONDS       secondi di "download" per URL (default 0.05)
+    FAKE_SPOTDL_FAILURE_RATE  frazione di URL che falliscono (default 0)
+    FAKE_SPOTDL_SEED          seme del generatore casuale
+
+install(directory) crea in `directory` un eseguibile `spotdl` che lancia
+questo script: basta anteporre la cartella al PATH.
+"""
+import os
+import random
+import stat
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from spotify_stub import Catalog, StubConfig
+
+
+def install(directory):
+    """Crea `directory/spotdl` e restituisce la cartella da anteporre al PATH."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'spotdl')
+    with open(path, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return directory
+
+
+def songs_for_url(catalog, url):
+    """Nomi "Artista - Titolo" delle canzoni di un URL del catalogo (l'URL stesso se non e' del catalogo)."""
+    kind, _, value = url.rstrip('/').rpartition('/')
+    try:
+        if kind.endswith('/track'):
+            tracks = [catalog.track_by_id(value)]
+        elif kind.endswith('/album'):
+            tracks = catalog.album_by_id(value, full=True)['tracks']['items']
+        else:
+            return [url]
+    except ValueError:
+        return [url]
+    return [f"{track['artists'][0]['name']} - {track['name']}" for track in tracks]
+
+
+def main(argv):
+    seconds = float(os.getenv('FAKE_SPOTDL_SECONDS', '0.05'))
+    failure_rate = float(os.getenv('FAKE_SPOTDL_FAILURE_RATE', '0'))
+    seed = os.getenv('FAKE_SPOTDL_SEED')
+    rng = random.Random(f"{seed}-{os.getpid()}" if seed is not None else None)
+
+    urls = []
+    for arg in argv:
+        if arg.startswith('--'):
+            break
+        urls.append(arg)
+
+    # Stessi parametri di default del catalogo servito da harness.prepare()
+    catalog = Catalog(StubConfig())
+    songs = [song for url in urls for song in songs_for_url(catalog, url)]
+    print(f"Processing query: {len(songs)} songs", flush=True)
+    for song in songs:
+        time.sleep(seconds)
+        if rng.random() < failure_rate:
+            print(f"LookupError: No results found for song: {song}", flush=True)
+        else:
+            print(f'Downloaded "{song}": https://music.youtube.com/watch?v=fake', flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,73 @@
+"""
+Parti comuni dei benchmark end-to-end: argomenti da riga di comando, avvio
+dello stub, cartella di lavoro temporanea e finto spotdl, report finale.
+
+prepare() imposta le variabili d'ambiente lette all'import dai moduli del
+progetto (URL dell'API, DATA_DIR, limiti): va chiamata prima di importarli.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from spotify_stub import StubConfig, start_stub_server
+import fake_spotdl
+
+
+def add_stub_arguments(parser):
+    group = parser.add_argument_group('stub API')
+    group.add_argument('--latency', type=float, default=0.02, help="latenza dello stub per richiesta, in secondi")
+    group.add_argument('--throttle-rate', type=float, default=0.0, help="frazione di richieste con risposta 429")
+    group.add_argument('--retry-after', type=int, default=0, help="Retry-After delle risposte 429, in secondi")
+    group.add_argument('--rate', type=float, default=None,
+                       help="SPOTIFY_RATE_LIMIT del client (default: quello configurato)")
+
+
+def add_spotdl_arguments(parser):
+    group = parser.add_argument_group('finto spotdl')
+    group.add_argument('--spotdl-seconds', type=float, default=0.05, help="secondi di download per traccia")
+    group.add_argument('--failure-rate', type=float, default=0.0, help="frazione di tracce che falliscono")
+    group.add_argument('--workers', type=int, default=3, help="processi spotdl in parallelo")
+
+
+def prepare(args, spotdl=False):
+    """
+    Avvia lo stub e prepara l'ambiente. Restituisce (server, base_url, workdir):
+    workdir e' una cartella temporanea con lo stato (DATA_DIR) del benchmark.
+    """
+    workdir = tempfile.mkdtemp(prefix='spotify-bench-')
+    config = StubConfig(latency=args.latency, throttle_rate=args.throttle_rate, retry_after=args.retry_after)
+    server, base_url = start_stub_server(config=config)
+    os.environ.update({
+        'SPOTIFY_API_URL': f"{base_url}/v1",
+        'SPOTIFY_AUTH_URL': f"{base_url}/api/token",
+        'DATA_DIR': os.path.join(workdir, 'data'),
+        'CLIENT_ID': 'bench-id',
+        'CLIENT_SECRET': 'bench-secret',
+    })
+    if args.rate:
+        os.environ['SPOTIFY_RATE_LIMIT'] = str(args.rate)
+        os.environ['SPOTIFY_RATE_BURST'] = str(max(1, int(args.rate)))
+    if spotdl:
+        bin_dir = fake_spotdl.install(os.path.join(workdir, 'bin'))
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+        os.environ['FAKE_SPOTDL_SECONDS'] = str(args.spotdl_seconds)
+        os.environ['FAKE_SPOTDL_FAILURE_RATE'] = str(args.failure_rate)
+        os.environ['DOWNLOAD_WORKERS'] = str(args.workers)
+    return server, base_url, workdir
+
+
+def report(label, elapsed, server, artists, tracks):
+    """Stampa artisti/min, tracce/min e chiamate API per traccia."""
+    api_calls = server.stats['requests']
+    minutes = elapsed / 60
+    print(f"\n=== {label} ===")
+    print(f"Tempo totale:          {elapsed:.1f}s")
+    print(f"Artisti:               {artists} ({artists / minutes:.1f}/min)")
+    print(f"Tracce:                {tracks} ({tracks / minutes:.1f}/min)")
+    print(f"Chiamate API:          {api_calls} ({server.stats['throttled']} risposte 429, "
+          f"{server.stats['token']} token)")
+    print(f"Chiamate API/traccia:  {api_calls / tracks:.3f}" if tracks else "Chiamate API/traccia:  -")
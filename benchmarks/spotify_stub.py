@@ -0,0 +1,254 @@
+"""
+Stub locale dell'API di Spotify, usato dai benchmark.
+
+Serve risposte JSON con la stessa forma di quelle reali senza toccare la rete,
+da un catalogo sintetico e deterministico: ogni artista ha album e singoli
+(i singoli sono registrazioni poi incluse nel primo album, con lo stesso
+ISRC), ogni album le sue tracce, ogni artista 20 artisti correlati. Gli ID
+hanno 22 caratteri come quelli veri.
+
+Le risposte sono paginate con `limit`/`offset`/`next` come l'API reale; con
+StubConfig si possono aggiungere una latenza per richiesta e una quota di
+risposte 429 con Retry-After. Il server parla HTTP/1.1 per permettere ai
+client di riutilizzare le connessioni.
+"""
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+
+class StubConfig:
+    def __init__(self, latency=0.0, throttle_rate=0.0, retry_after=0, artists=100000, albums_per_artist=4,
+                 singles_per_artist=2, tracks_per_album=10, related_artists=20, playlist_tracks=100, seed=0):
+        # Secondi di attesa per ogni richiesta GET
+        self.latency = latency
+        # Frazione delle richieste GET che ricevono un 429, con questo Retry-After
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.artists = artists
+        self.albums_per_artist = albums_per_artist
+        self.singles_per_artist = singles_per_artist
+        self.tracks_per_album = tracks_per_album
+        self.related_artists = related_artists
+        self.playlist_tracks = playlist_tracks
+        self.random = random.Random(seed)
+
+
+def _number(value, modulo):
+    """Numero stabile per un ID del catalogo o per un testo qualsiasi."""
+    digits = value[2:]
+    if digits.isdigit():
+        return int(digits)
+    return zlib.crc32(value.encode('utf-8')) % modulo
+
+
+def artist_id(n):
+    return f"ar{n:020d}"
+
+
+def album_id(artist, index):
+    return f"al{artist:012d}{index:08d}"
+
+
+def track_id(artist, album, index):
+    return f"tr{artist:010d}{album:05d}{index:05d}"
+
+
+class Catalog:
+    """Catalogo sintetico: tutti gli oggetti sono calcolati dagli ID."""
+
+    def __init__(self, config):
+        self.config = config
+
+    def artist(self, n):
+        return {
+            'id': artist_id(n),
+            'name': f"Artista {n}",
+            'popularity': (n * 37) % 101,
+            'genres': [],
+            'external_urls': {'spotify': f"https://open.spotify.com/artist/{artist_id(n)}"},
+        }
+
+    def related(self, n):
+        universe = self.config.artists
+        return [self.artist((n * 7919 + k * 104729 + 1) % universe) for k in range(self.config.related_artists)]
+
+    def _album_ref(self, value):
+        artist, index = int(value[2:14]), int(value[14:])
+        return artist, index
+
+    def album(self, artist, index, full=False):
+        is_single = index >= self.config.albums_per_artist
+        total = 1 if is_single else self.config.tracks_per_album
+        album = {
+            'id': album_id(artist, index),
+            'name': f"Singolo {artist}-{index}" if is_single else f"Album {artist}-{index}",
+            'album_type': 'single' if is_single else 'album',
+            'album_group': 'single' if is_single else 'album',
+            'release_date': f"{2024 - index % 20}-01-01",
+            'total_tracks': total,
+            'artists': [{'id': artist_id(artist), 'name': f"Artista {artist}"}],
+            'external_urls': {'spotify': f"https://open.spotify.com/album/{album_id(artist, index)}"},
+            'images': [],
+        }
+        if full:
+            album['tracks'] = {'items': [self.track(artist, index, i) for i in range(total)], 'next': None}
+        return album
+
+    def track(self, artist, album, index, full=False):
+        is_single = album >= self.config.albums_per_artist
+        # Il singolo k e' la traccia k del primo album (stessa registrazione)
+        recording = (0, album - self.config.albums_per_artist) if is_single else (album, index)
+        track = {
+            'id': track_id(artist, album, index),
+            'name': f"Brano {artist}-{recording[0]}-{recording[1]}",
+            'artists': [{'id': artist_id(artist), 'name': f"Artista {artist}"}],
+            'duration_ms': 150000 + (artist * 31 + recording[0] * 7 + recording[1]) % 90000,
+            'track_number': index + 1,
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id(artist, album, index)}"},
+        }
+        if full:
+            track['external_ids'] = {'isrc': f"QZSTB{(artist * 1000 + recording[0] * 50 + recording[1]) % 10 ** 7:07d}"}
+            track['album'] = self.album(artist, album)
+            track['popularity'] = (artist + index) % 101
+        return track
+
+    def artist_albums(self, n, groups):
+        indexes = []
+        if 'album' in groups:
+            indexes.extend(range(self.config.albums_per_artist))
+        if 'single' in groups:
+            indexes.extend(range(self.config.albums_per_artist,
+                                 self.config.albums_per_artist + self.config.singles_per_artist))
+        return [self.album(n, index) for index in indexes]
+
+    def album_by_id(self, value, full=False):
+        artist, index = self._album_ref(value)
+        return self.album(artist, index, full=full)
+
+    def track_by_id(self, value):
+        artist, album, index = int(value[2:12]), int(value[12:17]), int(value[17:])
+        return self.track(artist, album, index, full=True)
+
+    def playlist_items(self, playlist):
+        start = _number(playlist, self.config.artists)
+        return [
+            {'track': self.track((start + k * 13) % self.config.artists, 0, 0)}
+            for k in range(self.config.playlist_tracks)
+        ]
+
+    def search_artists(self, query, count=200):
+        start = _number(query, self.config.artists)
+        return [self.artist((start + k * 17) % self.config.artists) for k in range(count)]
+
+
+class SpotifyStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Header e corpo partono in due write(): senza TCP_NODELAY il keep-alive
+    # si scontra con Nagle + delayed ACK e ogni risposta paga ~40ms.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, key):
+        with self.server.stats_lock:
+            self.server.stats[key] += 1
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.path.startswith('/api/token'):
+            self._count('token')
+            self._send_json({'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600})
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def _page(self, items, path, query, default_limit=20):
+        """Pagina `items` come l'API reale (limit/offset/next)."""
+        limit = int(query.get('limit', [default_limit])[0])
+        offset = int(query.get('offset', [0])[0])
+        next_url = None
+        if offset + limit < len(items):
+            params = {key: values[0] for key, values in query.items()}
+            params.update(offset=offset + limit, limit=limit)
+            next_url = f"http://{self.headers.get('Host')}{path}?{urlencode(params)}"
+        return {'items': items[offset:offset + limit], 'total': len(items), 'limit': limit,
+                'offset': offset, 'next': next_url}
+
+    def do_GET(self):
+        config = self.server.config
+        catalog = self.server.catalog
+        url = urlsplit(self.path)
+        path, query = url.path, parse_qs(url.query)
+        parts = path.strip('/').split('/')
+
+        self._count('requests')
+        if config.latency:
+            time.sleep(config.latency)
+        if config.throttle_rate and config.random.random() < config.throttle_rate:
+            self._count('throttled')
+            self._send_json({'error': {'status': 429, 'message': 'API rate limit exceeded'}}, status=429,
+                            headers={'Retry-After': str(config.retry_after)})
+            return
+
+        ids = query.get('ids', [''])[0].split(',') if 'ids' in query else []
+        if parts[:2] == ['v1', 'artists'] and len(parts) == 4 and parts[3] == 'related-artists':
+            self._send_json({'artists': catalog.related(_number(parts[2], config.artists))})
+        elif parts[:2] == ['v1', 'artists'] and len(parts) == 4 and parts[3] == 'albums':
+            groups = query.get('include_groups', ['album,single'])[0].split(',')
+            albums = catalog.artist_albums(_number(parts[2], config.artists), groups)
+            self._send_json(self._page(albums, path, query))
+        elif parts == ['v1', 'artists']:
+            self._send_json({'artists': [catalog.artist(_number(value, config.artists)) for value in ids]})
+        elif parts == ['v1', 'albums']:
+            self._send_json({'albums': [catalog.album_by_id(value, full=True) for value in ids]})
+        elif parts[:2] == ['v1', 'albums'] and len(parts) == 4 and parts[3] == 'tracks':
+            album = catalog.album_by_id(parts[2], full=True)
+            self._send_json(self._page(album['tracks']['items'], path, query))
+        elif parts == ['v1', 'tracks']:
+            self._send_json({'tracks': [catalog.track_by_id(value) for value in ids]})
+        elif parts[:2] == ['v1', 'playlists'] and len(parts) == 4 and parts[3] == 'tracks':
+            self._send_json(self._page(catalog.playlist_items(parts[2]), path, query, default_limit=100))
+        elif parts == ['v1', 'search']:
+            search_type = query.get('type', ['artist'])[0]
+            search_query = query.get('q', [''])[0]
+            if search_type == 'playlist':
+                playlists = [{'id': f"pl{_number(search_query, 10 ** 20):020d}", 'name': search_query}]
+                self._send_json({'playlists': self._page(playlists, path, query)})
+            else:
+                self._send_json({'artists': self._page(catalog.search_artists(search_query), path, query)})
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+
+def start_stub_server(host='127.0.0.1', port=0, config=None):
+    """
+    Avvia lo stub in un thread daemon e restituisce (server, base_url).
+    `server.stats` conta richieste, 429 e token emessi.
+    """
+    server = ThreadingHTTPServer((host, port), SpotifyStubHandler)
+    server.daemon_threads = True
+    server.config = config or StubConfig()
+    server.catalog = Catalog(server.config)
+    server.stats = Counter()
+    server.stats_lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://{host}:{server.server_address[1]}"
+    return server, base_url
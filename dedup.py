@@ -0,0 +1,97 @@
+import re
+import unicodedata
+
+# Suffissi di edizione: "(Deluxe Edition)", "- 2011 Remaster", "[Bonus Track]", ...
+_EDITION_RE = re.compile(
+    r"\b(deluxe|remaster(ed)?|expanded|anniversary|edition|bonus|explicit|clean|reissue)\b", re.IGNORECASE
+)
+# Collaborazioni: "(feat. X)", "[with X]"
+_FEATURE_RE = re.compile(r"^\s*(feat\.?|ft\.?|featuring|with)\s", re.IGNORECASE)
+_BRACKETS_RE = re.compile(r"\s*[\(\[]([^\)\]]*)[\)\]]")
+_DASH_SUFFIX_RE = re.compile(r"\s+-\s+(.*)$")
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+# Differenza massima di durata tra due tracce con lo stesso titolo normalizzato
+DURATION_TOLERANCE_MS = 3000
+
+def _is_edition_suffix(text):
+    return bool(_EDITION_RE.search(text) or _FEATURE_RE.match(text))
+
+def normalize_title(title):
+    """
+    Normalizza un titolo per il confronto: minuscolo, senza accenti, senza
+    suffissi di edizione e featuring. "Album (Deluxe Edition)" e
+    "Album - 2011 Remaster" diventano entrambi "album"; "Song (Live)" o
+    "Song - Radio Edit" restano distinti.
+    """
+    title = unicodedata.normalize('NFKD', title or '')
+    title = ''.join(c for c in title if not unicodedata.combining(c)).lower()
+    title = _BRACKETS_RE.sub(lambda m: '' if _is_edition_suffix(m.group(1)) else m.group(0), title)
+    match = _DASH_SUFFIX_RE.search(title)
+    if match and _is_edition_suffix(match.group(1)):
+        title = title[:match.start()]
+    return ' '.join(_PUNCTUATION_RE.sub(' ', title).split())
+
+def dedup_releases(releases):
+    """
+    Tiene una sola edizione per release: tra le release dello stesso tipo con
+    lo stesso titolo normalizzato resta quella con piu' tracce (la deluxe
+    contiene la standard). Gli album vengono prima dei singoli, cosi' le
+    tracce dei singoli poi inclusi in un album risultano gia' viste.
+    """
+    best = {}
+    for release in releases:
+        key = (normalize_title(release.get('name')), release.get('album_type'))
+        current = best.get(key)
+        if current is None or release.get('total_tracks', 0) > current.get('total_tracks', 0):
+            best[key] = release
+    kept = {id(release) for release in best.values()}
+    unique = [release for release in releases if id(release) in kept]
+    unique.sort(key=lambda release: release.get('album_type') != 'album')
+    return unique
+
+class TrackDeduplicator:
+    """
+    Riconosce le tracce gia' viste in una sessione di download.
+
+    Una traccia e' un duplicato se ha lo stesso ID Spotify o lo stesso ISRC
+    di una traccia gia' vista, oppure lo stesso titolo normalizzato, un
+    artista in comune e una durata entro DURATION_TOLERANCE_MS (la stessa
+    registrazione pubblicata come singolo, nell'album e nella deluxe, o
+    sotto piu' artisti in caso di collaborazioni).
+    """
+    def __init__(self):
+        self._track_ids = set()
+        self._isrcs = set()
+        self._durations = {}
+
+    def _keys(self, track):
+        title = normalize_title(track.get('name'))
+        return [(title, artist.get('id')) for artist in track.get('artists', []) if artist.get('id')]
+
+    def is_duplicate(self, track, isrc=None):
+        if track.get('id') in self._track_ids or (isrc and isrc in self._isrcs):
+            return True
+        duration = track.get('duration_ms')
+        if duration is None:
+            return False
+        return any(
+            abs(duration - seen) <= DURATION_TOLERANCE_MS
+            for key in self._keys(track)
+            for seen in self._durations.get(key, ())
+        )
+
+    def add(self, track, isrc=None):
+        """Registra la traccia. Restituisce False se era un duplicato."""
+        duplicate = self.is_duplicate(track, isrc)
+        if track.get('id'):
+            self._track_ids.add(track['id'])
+        if isrc:
+            self._isrcs.add(isrc)
+        if track.get('duration_ms') is not None:
+            for key in self._keys(track):
+                self._durations.setdefault(key, []).append(track['duration_ms'])
+        return not duplicate
+
+    def __len__(self):
+        return len(self._track_ids)
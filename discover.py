@@ -1,9 +1,19 @@
 import os
 import json
 import time
-import subprocess
+import asyncio
+import argparse
+import threading
 from dotenv import load_dotenv
-from spotify_client import SpotifyClient
+from spotify_client import SpotifyClient, MAX_SEARCH_RESULTS
+from async_spotify_client import AsyncSpotifyClient, DEFAULT_CONCURRENCY
+from downloader import DownloadExecutor, DOWNLOAD_WORKERS, COMPLETED, TIMED_OUT, song_display_name
+from library_index import LibraryIndex, track_id_from_url
+from state_store import StateStore
+from artist_graph import ArtistGraph, CONNECTION_WEIGHT, HOP_PENALTY
+from dedup import TrackDeduplicator
+from pipeline import DownloadPipeline
+import metrics
 
 # Carica le variabili d'ambiente
 load_dotenv()
@@ -11,8 +21,6 @@ CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
 # Costanti per i nomi dei file
-SEED_FILE = 'seed_artists.txt'
-PROCESSED_FILE = 'processed_artists.txt'
 SETTINGS_FILE = 'discovery_settings.json'
 
 def load_settings():
@@ -24,26 +32,20 @@ def load_settings():
         print(f"ERRORE: File '{SETTINGS_FILE}' non trovato.")
         return None
 
-def read_ids_from_file(filename):
-    """Legge gli ID da un file, uno per riga."""
-    if not os.path.exists(filename):
-        return set()
-    with open(filename, 'r') as f:
-        return {line.strip() for line in f if line.strip()}
-
-def write_ids_to_file(filename, ids):
-    """Scrive un set di ID in un file, uno per riga."""
-    with open(filename, 'w') as f:
-        for item_id in sorted(list(ids)):
-            f.write(f"{item_id}\n")
-
-def discover_related_artists(client, settings):
-    """Logica di scoperta basata sugli artisti correlati."""
+async def _tagged(key, coro):
+    return key, await coro
+
+def _as_completed(calls):
+    """Esegue in parallelo le coroutine di {chiave: coroutine}, restituendo (chiave, risultato) man mano che finiscono."""
+    return asyncio.as_completed([_tagged(key, coro) for key, coro in calls.items()])
+
+async def discover_related_artists(client, settings, store, on_artist=None):
+    """
+    Logica di scoperta basata sugli artisti correlati (seed interrogati in
+    parallelo). Ogni artista trovato viene passato subito a `on_artist`.
+    """
     print("\n--- Inizio scoperta per Artisti Correlati ---")
-    seed_artists = read_ids_from_file(SEED_FILE)
-    processed_artists = read_ids_from_file(PROCESSED_FILE)
-    
-    new_seeds = seed_artists - processed_artists
+    new_seeds = store.pending_seeds()
     artists_to_download = set()
 
     if not new_seeds:
@@ -52,33 +54,121 @@ def discover_related_artists(client, settings):
         print(f"Trovati {len(new_seeds)} nuovi artisti seme: {', '.join(new_seeds)}")
         popularity_threshold = settings.get('popularity_threshold_artist', 50)
 
-        for artist_id in new_seeds:
+        failed_seeds = set()
+        for result in _as_completed({artist_id: client.get_related_artists(artist_id) for artist_id in new_seeds}):
+            artist_id, related = await result
             print(f"\nProcesso l'artista seme: {artist_id}")
-            related = client.get_related_artists(artist_id)
-            
+            if related is None:
+                print("  Artisti correlati non disponibili: riprovo alla prossima esecuzione.")
+                failed_seeds.add(artist_id)
+                continue
             for artist in related:
                 artist_name = artist.get('name')
                 artist_popularity = artist.get('popularity', 0)
                 related_artist_id = artist.get('id')
 
-                if related_artist_id in processed_artists:
+                if related_artist_id in artists_to_download or store.is_processed(related_artist_id):
                     continue
 
                 if artist_popularity >= popularity_threshold:
                     print(f"  -> Trovato artista correlato popolare: {artist_name} (Pop: {artist_popularity})... AGGIUNTO ALLA CODA.")
                     artists_to_download.add(related_artist_id)
-            
-            processed_artists.add(artist_id)
-            time.sleep(1)
+                    if on_artist:
+                        on_artist(related_artist_id)
+
+        # I seed diventano processati e lasciano la lista dei seed (tranne quelli falliti)
+        done_seeds = [artist_id for artist_id in new_seeds if artist_id not in failed_seeds]
+        store.mark_processed(done_seeds)
+        store.remove_seeds(done_seeds)
 
-    write_ids_to_file(PROCESSED_FILE, processed_artists)
-    remaining_seeds = seed_artists - new_seeds
-    write_ids_to_file(SEED_FILE, remaining_seeds)
     print("--- Fine scoperta per Artisti Correlati ---")
-    return processed_artists, artists_to_download
+    return artists_to_download
+
+async def crawl_related_artists(client, settings, store, on_artist=None):
+    """
+    Scoperta multi-hop sul grafo degli artisti correlati. Parte dai seed e
+    dalla frontiera salvata dall'esecuzione precedente ed espande per primi
+    gli artisti con il punteggio piu' alto (popolarita', collegamenti, distanza),
+    fino a `crawl_max_depth` hop e `crawl_budget` chiamate API. Le richieste
+    partono a ondate di `max_concurrent_requests`; dopo ogni ondata i nodi
+    toccati vengono salvati, quindi un crawl interrotto riprende da li'.
+    """
+    print("\n--- Inizio crawl del grafo degli Artisti Correlati ---")
+    max_depth = settings.get('crawl_max_depth', 3)
+    budget = settings.get('crawl_budget', 200)
+    wave_size = settings.get('max_concurrent_requests', DEFAULT_CONCURRENCY)
+    popularity_threshold = settings.get('popularity_threshold_artist', 50)
+
+    graph = ArtistGraph(
+        connection_weight=settings.get('crawl_connection_weight', CONNECTION_WEIGHT),
+        hop_penalty=settings.get('crawl_hop_penalty', HOP_PENALTY),
+    )
+    for artist_id, hop, popularity, connections, expanded in store.load_crawl():
+        graph.add(artist_id, hop, popularity, connections, expanded)
+    resumed = len(graph)
+
+    new_seeds = store.pending_seeds()
+    for artist_id in new_seeds:
+        # I seed partono a distanza 0 e con la priorita' massima
+        graph.add(artist_id, 0, popularity=100)
+    store.save_crawl_nodes([(artist_id, *graph.info(artist_id)) for artist_id in new_seeds])
+    print(f"Grafo: {resumed} artisti ripresi dal crawl precedente, {len(new_seeds)} nuovi seed.")
+
+    artists_to_download = set()
+    # Artisti la cui espansione e' gia' fallita una volta in questo crawl
+    failed = set()
+    calls = 0
+    while calls < budget:
+        wave = []
+        while len(wave) < min(wave_size, budget - calls):
+            artist_id = graph.pop(max_depth)
+            if artist_id is None:
+                break
+            wave.append(artist_id)
+        if not wave:
+            break
+        calls += len(wave)
+
+        results = await asyncio.gather(*(client.get_related_artists(artist_id) for artist_id in wave))
+
+        touched = set(wave)
+        for artist_id, related in zip(wave, results):
+            if related is None:
+                # Chiamata fallita: l'artista resta da espandere. Si riprova una
+                # volta in questo crawl, poi se ne occupa quello successivo
+                graph.release(artist_id, requeue=artist_id not in failed)
+                failed.add(artist_id)
+                continue
+            graph.add_edges(artist_id, related)
+            for artist in related:
+                related_artist_id = artist.get('id')
+                if not related_artist_id:
+                    continue
+                touched.add(related_artist_id)
+                if related_artist_id in artists_to_download or store.is_processed(related_artist_id):
+                    continue
+                if artist.get('popularity', 0) >= popularity_threshold:
+                    hop = graph.info(related_artist_id)[0]
+                    print(f"  -> Trovato artista correlato popolare: {artist.get('name')} "
+                          f"(Pop: {artist.get('popularity', 0)}, hop {hop})... AGGIUNTO ALLA CODA.")
+                    artists_to_download.add(related_artist_id)
+                    if on_artist:
+                        on_artist(related_artist_id)
+        store.save_crawl_nodes([(artist_id, *graph.info(artist_id)) for artist_id in touched])
+
+    store.mark_processed(new_seeds)
+    store.remove_seeds(new_seeds)
+    print(f"Crawl: {calls} chiamate API ({sum(not graph.info(artist_id)[3] for artist_id in failed)} artisti non espansi per errore), {len(graph)} nel grafo, "
+          f"{len(graph.frontier(max_depth))} ancora in frontiera.")
+    print("--- Fine crawl del grafo degli Artisti Correlati ---")
+    return artists_to_download
 
-def discover_from_top_charts(client, settings, processed_artists):
-    """Logica di scoperta basata sulle classifiche Top."""
+async def discover_from_top_charts(client, settings, store, on_artist=None):
+    """
+    Logica di scoperta basata sulle classifiche Top (playlist lette in
+    parallelo). Gli artisti delle tracce non hanno la popolarita': quelli
+    nuovi vengono completati in blocco, 50 per chiamata.
+    """
     print("\n--- Inizio scoperta dalle Top Charts ---")
     playlist_ids = settings.get('top_chart_playlists', {})
     artists_to_download = set()
@@ -88,30 +178,39 @@ def discover_from_top_charts(client, settings, processed_artists):
         return artists_to_download
 
     popularity_threshold = settings.get('popularity_threshold_artist', 50)
+    # Artisti gia' valutati in questa scoperta, da una classifica precedente
+    seen = set()
 
-    for chart_name, playlist_id in playlist_ids.items():
+    calls = {chart_name: client.get_playlist_track_artists(playlist_id) for chart_name, playlist_id in playlist_ids.items()}
+    for result in _as_completed(calls):
+        chart_name, artists = await result
         print(f"\nProcesso la classifica: {chart_name}")
-        artists = client.get_playlist_track_artists(playlist_id)
         if not artists:
             continue
 
+        candidates = []
         for artist in artists:
             artist_id = artist.get('id')
-            if artist_id in processed_artists or artist_id in artists_to_download:
+            if not artist_id or artist_id in seen or store.is_known(artist_id):
                 continue
+            seen.add(artist_id)
+            candidates.append(artist_id)
+        print(f"  {len(artists)} tracce, {len(candidates)} artisti nuovi da valutare.")
 
+        for artist in await client.get_artists_bulk(candidates):
+            artist_id = artist.get('id')
             artist_popularity = artist.get('popularity', 0)
             if artist_popularity >= popularity_threshold:
                 print(f"  -> Trovato artista popolare: {artist.get('name')} (Pop: {artist_popularity})... AGGIUNTO ALLA CODA.")
                 artists_to_download.add(artist_id)
-        
-        time.sleep(1)
+                if on_artist:
+                    on_artist(artist_id)
 
     print("--- Fine scoperta dalle Top Charts ---")
     return artists_to_download
 
-def discover_from_genres(client, settings, processed_artists):
-    """Logica di scoperta basata sui generi musicali."""
+async def discover_from_genres(client, settings, store, on_artist=None):
+    """Logica di scoperta basata sui generi musicali (ricerche in parallelo)."""
     print("\n--- Inizio scoperta per Generi Musicali ---")
     genres = settings.get('seed_genres', [])
     artists_to_download = set()
@@ -121,113 +220,322 @@ def discover_from_genres(client, settings, processed_artists):
         return artists_to_download
 
     popularity_threshold = settings.get('popularity_threshold_artist', 50)
-
-    for genre in genres:
-        print(f"\nProcesso il genere: {genre}")
-        results = client.search_for_genre(genre)
-            
+    max_results = settings.get('genre_search_max_results', MAX_SEARCH_RESULTS)
+    # Lo stesso artista compare spesso sotto piu' generi
+    seen = set()
+
+    calls = {genre: client.search_for_genre(genre, max_results) for genre in genres}
+    for result in _as_completed(calls):
+        genre, results = await result
+        print(f"\nProcesso il genere: {genre} ({len(results)} artisti)")
         for artist in results:
             artist_id = artist.get('id')
-            if artist_id in processed_artists or artist_id in artists_to_download:
+            if not artist_id or artist_id in seen or store.is_known(artist_id):
                 continue
+            seen.add(artist_id)
 
             artist_popularity = artist.get('popularity', 0)
             if artist_popularity >= popularity_threshold:
                 print(f"  -> Trovato artista popolare: {artist.get('name')} (Pop: {artist_popularity})... AGGIUNTO ALLA CODA.")
                 artists_to_download.add(artist_id)
-        
-        time.sleep(1)
+                if on_artist:
+                    on_artist(artist_id)
 
     print("--- Fine scoperta per Generi Musicali ---")
     return artists_to_download
 
-def download_artist_main_releases(client, artist_id, cookie_file):
+def fetch_isrcs(client, track_ids):
+    """ISRC delle tracce indicate ({track_id: isrc}), 50 tracce per chiamata."""
+    return {
+        track['id']: track.get('external_ids', {}).get('isrc')
+        for track in client.get_tracks_by_ids(track_ids)
+        if track and track.get('id')
+    }
+
+def expand_artist_releases(client, artist_id, library=None, dedup=None, releases=None, fetch_isrc=True, isrcs=None):
     """
-    Scarica le tracce degli album e dei singoli principali di un artista,
-    una per una, per evitare il rate limiting.
+    Trasforma un artista nei batch da scaricare: uno per release, con le sole
+    tracce mancanti. Le tracce gia' presenti nella libreria (se indicata)
+    vengono saltate, cosi' come quelle gia' viste da `dedup` (un
+    TrackDeduplicator condiviso tra tutti gli artisti della sessione): stessa
+    traccia, stesso ISRC o stessa registrazione in un'altra edizione.
+    Con `releases` si considerano solo quelle release (modalita' refresh).
+    Gli ISRC trovati vengono aggiunti a `isrcs`. Restituisce (release, batch).
     """
-    print(f"\n--- Inizio download per l'artista {artist_id} ---")
-    
-    releases = client.get_artist_albums(artist_id)
+    print(f"\n--- Espansione dell'artista {artist_id} ---")
+
+    if releases is None:
+        releases = client.get_artist_albums(artist_id)
     if not releases:
         print(f"Nessun album o singolo principale trovato da scaricare per l'artista {artist_id}.")
-        return
+        return [], []
+    if dedup is None:
+        dedup = TrackDeduplicator()
+    if isrcs is None:
+        isrcs = {}
 
     print(f"Trovati {len(releases)} album/singoli. Recupero di tutte le tracce...")
-    
-    all_tracks_to_download = []
-    for release in releases:
-        tracks = client.get_album_tracks(release.get('id'))
-        if tracks:
-            for track in tracks:
-                track_url = track.get('external_urls', {}).get('spotify')
-                if track_url:
-                    all_tracks_to_download.append(track_url)
-        time.sleep(1)
-
-    if not all_tracks_to_download:
-        print("Nessuna traccia trovata negli album/singoli dell'artista.")
+
+    # Tracklist in blocco: una chiamata ogni 20 release invece di una per release.
+    full_releases = client.get_albums_bulk([release['id'] for release in releases])
+
+    # Le tracklist degli album non riportano l'ISRC: lo chiediamo (50 tracce per
+    # chiamata) solo per le tracce che non sappiamo gia' di poter saltare
+    if fetch_isrc:
+        candidates = [
+            track['id']
+            for release in full_releases
+            for track in release.get('tracks', {}).get('items', [])
+            if track.get('id') and not dedup.is_duplicate(track)
+            and not (library and library.has_track(track['id']))
+        ]
+        if candidates:
+            isrcs.update(fetch_isrcs(client, candidates))
+
+    # Un batch per release: un solo processo spotdl scarica tutte le sue tracce
+    batches = []
+    already_downloaded = duplicates = 0
+    for release in full_releases:
+        tracks = release.get('tracks', {}).get('items', [])
+        items = []
+        for track in tracks:
+            track_url = track.get('external_urls', {}).get('spotify')
+            if not track_url:
+                continue
+            isrc = isrcs.get(track.get('id'))
+            if library and library.has_track(track.get('id'), isrc):
+                already_downloaded += 1
+                continue
+            if not dedup.add(track, isrc):
+                duplicates += 1
+                continue
+            items.append((song_display_name(track), track_url))
+        if items:
+            batches.append((release.get('name'), items))
+
+    if already_downloaded:
+        print(f"{already_downloaded} tracce gia' presenti in libreria, saltate.")
+    if duplicates:
+        print(f"{duplicates} tracce duplicate (altre edizioni, singoli gia' negli album, collaborazioni), saltate.")
+    if batches:
+        total = sum(len(items) for _, items in batches)
+        print(f"Artista {artist_id}: {total} tracce in {len(batches)} release accodate per il download.")
+    else:
+        print("Nessuna nuova traccia da scaricare negli album/singoli dell'artista.")
+    return releases, batches
+
+async def find_new_releases(client, store, artist_ids):
+    """
+    Per ogni artista restituisce le release successive al suo watermark,
+    interrogando l'API in parallelo. Gli artisti senza release note (processati
+    prima del tracciamento) vengono solo registrati, senza scaricare nulla.
+    """
+    async def check(artist_id):
+        known_ids, latest_date = store.release_watermark(artist_id)
+        if not known_ids:
+            # Primo controllo: l'intero catalogo diventa il punto di partenza
+            store.record_releases(artist_id, await client.get_artist_albums(artist_id) or [])
+            return artist_id, []
+        return artist_id, await client.get_new_artist_albums(artist_id, known_ids, latest_date)
+
+    return await asyncio.gather(*(check(artist_id) for artist_id in artist_ids))
+
+async def refresh_processed_artists(client, settings, store, on_releases):
+    """
+    Modalita' refresh: controlla le nuove uscite degli artisti gia' processati
+    e passa a `on_releases(artist_id, release)` solo quelle non ancora note.
+    """
+    interval = settings.get('refresh_interval_hours', 24) * 3600
+    artist_ids = store.artists_to_refresh(time.time() - interval, limit=settings.get('refresh_max_artists'))
+    print(f"\n--- Inizio refresh delle nuove uscite ({len(artist_ids)} artisti da controllare) ---")
+    if not artist_ids:
         return
 
-    print(f"Inizio il download di {len(all_tracks_to_download)} tracce totali.")
-    output_dir = "/app/music"
-
-    for i, track_url in enumerate(all_tracks_to_download):
-        print(f"  Scaricando traccia {i+1}/{len(all_tracks_to_download)}: {track_url}")
-        command = ['spotdl', track_url, '--format', 'opus', '--output', output_dir]
-        if cookie_file and os.path.exists(cookie_file):
-            command.extend(['--cookie-file', cookie_file])
-        
-        try:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8', bufsize=1)
-            for line in iter(process.stdout.readline, ''):
-                pass
-            process.wait(timeout=180)
-            if process.returncode == 0:
-                print(f"    -> Download completato con successo.")
-            else:
-                print(f"    -> ATTENZIONE: spotdl ha restituito un errore per {track_url}")
-        except subprocess.TimeoutExpired:
-            process.kill()
-            print(f"    -> ERRORE: Timeout superato per {track_url}")
-        except Exception as e:
-            print(f"    -> ERRORE CRITICO per {track_url}: {e}")
-        
-        time.sleep(2)
-
-def main():
+    for artist_id, new_releases in await find_new_releases(client, store, artist_ids):
+        if not new_releases:
+            store.record_releases(artist_id, [])
+            continue
+        print(f"\nArtista {artist_id}: {len(new_releases)} nuove release.")
+        on_releases(artist_id, new_releases)
+    print("--- Fine refresh delle nuove uscite ---")
+
+async def run_discovery(client, settings, store, on_artist=None):
+    """
+    Esegue le tre fasi di scoperta in parallelo, nel limite di richieste
+    del client asincrono. Ogni artista trovato viene passato subito a
+    `on_artist`; alla fine restituisce l'insieme degli artisti da scaricare.
+    """
+    if settings.get('related_artists_crawl', False):
+        related_phase = crawl_related_artists(client, settings, store, on_artist)
+    else:
+        related_phase = discover_related_artists(client, settings, store, on_artist)
+    new_artists_related, new_artists_charts, new_artists_genres = await asyncio.gather(
+        related_phase,
+        discover_from_top_charts(client, settings, store, on_artist),
+        discover_from_genres(client, settings, store, on_artist),
+    )
+    return new_artists_related.union(new_artists_charts, new_artists_genres)
+
+async def produce_artists(client, settings, store, pipeline, refresh=False, add_artist=None):
+    """
+    Produttore della pipeline: scoperta ed eventuale refresh, nello stesso
+    event loop. `add_artist(artist_id, releases=None)` sostituisce
+    pipeline.add_artist (per esempio per registrare l'artista prima).
+    """
+    add_artist = add_artist or pipeline.add_artist
+    try:
+        found = await run_discovery(client, settings, store, on_artist=add_artist)
+        if found:
+            print(f"\nScoperta terminata: {len(found)} artisti unici trovati.")
+        else:
+            print("\nNessun nuovo artista trovato in questa sessione.")
+        if refresh:
+            await refresh_processed_artists(client, settings, store, on_releases=add_artist)
+    finally:
+        pipeline.close()
+
+def drain_retry_queue(store, executor, library, settings, on_result):
+    """
+    Riprova le tracce fallite nelle esecuzioni precedenti (o in questa) il cui
+    backoff e' scaduto. Se la prossima scade entro `retry_drain_wait_seconds`
+    la aspetta, altrimenti resta in coda per la prossima esecuzione.
+    """
+    max_wait = settings.get('retry_drain_wait_seconds', 300)
+    while True:
+        due = store.due_retries()
+        if not due:
+            next_at = store.next_retry_at()
+            if next_at is None or next_at - time.time() > max_wait:
+                break
+            time.sleep(max(0, next_at - time.time()))
+            continue
+
+        # Tracce gia' scaricate nel frattempo (per esempio dall'interfaccia web)
+        done = [url for url, _, _ in due if library.has_url(url)]
+        store.remove_retries(done)
+        due = [row for row in due if row[0] not in done]
+        if not due:
+            continue
+
+        print(f"\n--- Nuovo tentativo per {len(due)} tracce non riuscite ---")
+        artists = {url: artist_id for url, _, artist_id in due}
+        jobs = executor.submit_chunked(
+            "Tentativi", [(name, url) for url, name, _ in due],
+            on_result=lambda job, url, status: on_result(artists.get(url), job, url, status),
+        )
+        for job in jobs:
+            job.future.result()
+
+    remaining = store.retry_count()
+    if remaining:
+        print(f"{remaining} tracce restano in coda per un nuovo tentativo alla prossima esecuzione.")
+
+def main(refresh=False):
     print("Avvio dello script di scoperta musicale...")
     settings = load_settings()
     if not settings:
         return
 
-    client = SpotifyClient(CLIENT_ID, CLIENT_SECRET)
-
-    processed_artists, new_artists_related = discover_related_artists(client, settings)
-    all_known_artists = processed_artists.union(new_artists_related)
-    
-    new_artists_charts = discover_from_top_charts(client, settings, all_known_artists)
-    all_known_artists.update(new_artists_charts)
-
-    new_artists_genres = discover_from_genres(client, settings, all_known_artists)
-    
-    final_artists_to_download = new_artists_related.union(new_artists_charts, new_artists_genres)
-
-    if final_artists_to_download:
-        print(f"\n--- Inizio Download Automatico ---")
-        print(f"Totale artisti unici da scaricare: {len(final_artists_to_download)}")
-        cookie_file = "cookies.txt"
-        
-        for i, artist_id in enumerate(sorted(list(final_artists_to_download))):
-            print(f"\nScaricando artista {i+1}/{len(final_artists_to_download)}: {artist_id}")
-            download_artist_main_releases(client, artist_id, cookie_file)
-            processed_artists.add(artist_id)
-            write_ids_to_file(PROCESSED_FILE, processed_artists)
-            print(f"Artista {artist_id} segnato come processato.")
-    else:
-        print("\nNessun nuovo artista da scaricare in questa sessione complessiva.")
+    concurrency = settings.get('max_concurrent_requests', DEFAULT_CONCURRENCY)
+    client = SpotifyClient(CLIENT_ID, CLIENT_SECRET, pool_maxsize=concurrency)
+    async_client = AsyncSpotifyClient(sync_client=client, concurrency=concurrency)
+
+    store = StateStore()
+
+    executor = DownloadExecutor(
+        max_workers=settings.get('max_parallel_downloads', DOWNLOAD_WORKERS),
+        cookie_file="cookies.txt",
+    )
+    library = LibraryIndex(music_dir=executor.output_dir)
+    scan = library.scan()
+    print(f"Libreria: {scan['seen']} file ({scan['indexed']} nuovi o modificati, {scan['removed']} rimossi).")
+    # Deduplicazione condivisa da tutti gli artisti della sessione
+    dedup = TrackDeduplicator()
+    fetch_isrc = settings.get('dedup_fetch_isrc', True)
+    isrcs = {}
+
+    def expand(artist_id, releases):
+        return expand_artist_releases(client, artist_id, library, dedup, releases, fetch_isrc, isrcs)
+
+    max_attempts = settings.get('retry_max_attempts', 3)
+    backoff = settings.get('retry_backoff_seconds', 60)
+
+    def on_result(artist_id, job, url, status):
+        # Checkpoint per traccia: al riavvio l'espansione salta quelle gia' in libreria
+        if status == COMPLETED:
+            library.mark_downloaded([track_id_from_url(url)], isrcs)
+            store.remove_retries([url])
+            return
+        name = next((name for name, item_url in job.items if item_url == url), url)
+        if store.schedule_retry(url, name, artist_id, status, max_attempts, backoff) is None:
+            print(f"       ATTENZIONE: {name} abbandonata dopo {max_attempts} tentativi.")
+
+    def on_batch_done(job):
+        failed = [name for name, url in job.items if job.results.get(url) != COMPLETED]
+        if job.status == TIMED_OUT:
+            print(f"    -> ERRORE: Timeout superato per '{job.name}'")
+        elif job.error:
+            print(f"    -> ERRORE CRITICO per '{job.name}': {job.error}")
+        print(f"    -> '{job.name}': {len(job.items) - len(failed)}/{len(job.items)} tracce scaricate.")
+        for name in failed:
+            print(f"       ATTENZIONE: download non riuscito per {name}")
+
+    def on_artist_done(artist_id, releases):
+        store.record_releases(artist_id, releases)
+        store.mark_processed([artist_id])
+        store.remove_pending_artist(artist_id)
+        print(f"Artista {artist_id} segnato come processato.")
+
+    # Scoperta, espansione e download si sovrappongono: il primo download
+    # parte appena la prima release e' pronta, non a fine scoperta
+    print(f"\n--- Inizio Scoperta e Download Automatico ({executor.max_workers} download in parallelo) ---")
+    pipeline = DownloadPipeline(
+        executor, expand, on_artist_done=on_artist_done, on_batch_done=on_batch_done, on_result=on_result,
+        queue_size=settings.get('download_queue_size'),
+    ).start()
+
+    def add_artist(artist_id, releases=None):
+        store.add_pending_artist(artist_id, releases)
+        pipeline.add_artist(artist_id, releases)
+
+    # Artisti interrotti dall'esecuzione precedente: ripartono dalla prima
+    # traccia non ancora in libreria
+    resumed = store.pending_artists()
+    if resumed:
+        print(f"Ripresa di {len(resumed)} artisti rimasti a meta' nell'esecuzione precedente.")
+    for artist_id, releases in resumed:
+        pipeline.add_artist(artist_id, releases)
+
+    refresh = refresh or settings.get('refresh_processed_artists', False)
+    producer = threading.Thread(
+        target=lambda: asyncio.run(produce_artists(async_client, settings, store, pipeline, refresh, add_artist)),
+        name='discovery', daemon=True,
+    )
+    producer.start()
+    pipeline.run()
+    producer.join()
+    drain_retry_queue(store, executor, library, settings, on_result)
+    executor.shutdown()
+
+    elapsed = time.monotonic() - pipeline.started_at
+    print(f"\nPipeline: {pipeline.artists_expanded} artisti, {pipeline.tracks_submitted} tracce in "
+          f"{pipeline.batches_submitted} batch, {elapsed:.0f}s totali.")
+
+    summary = metrics.summary()
+    if summary:
+        print("\n--- Metriche della sessione ---")
+        for line in summary:
+            print(line)
+
+    if client.cache:
+        stats = client.cache.stats()
+        print(f"\nCache API: {stats['hits']} hit, {stats['misses']} miss "
+              f"(hit rate {stats['hit_rate']:.0%}), {stats['entries']} voci, {stats['size_bytes'] // 1024} KB.")
 
     print("\nScript di scoperta completato.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Scoperta e download automatico di nuovi artisti.")
+    parser.add_argument('--refresh', action='store_true',
+                        help="controlla anche le nuove uscite degli artisti gia' processati")
+    main(refresh=parser.parse_args().refresh)
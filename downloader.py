@@ -0,0 +1,447 @@
+import os
+import re
+import itertools
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import metrics
+from process_runner import StreamingProcess, kill_process_tree, rotating_log
+from postprocess import PostProcessor, postprocess_enabled
+from library_index import AUDIO_EXTENSIONS, track_id_from_url
+
+# Impostazioni di default per i download con spotdl
+OUTPUT_DIR = "/app/music"
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "180"))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "3"))
+# URL massimi passati a una singola invocazione di spotdl
+BATCH_SIZE = int(os.getenv("DOWNLOAD_BATCH_SIZE", "50"))
+# Ultime righe di output tenute in memoria per ogni job
+DOWNLOAD_LOG_LINES = int(os.getenv("DOWNLOAD_LOG_LINES", "50"))
+# Ogni quanti secondi l'elenco dei brani in libreria (vedi _skip_existing) viene riletto dal disco
+LIBRARY_NAMES_TTL = int(os.getenv("LIBRARY_NAMES_TTL", "3600"))
+# Output completo di spotdl su file, ruotato oltre DOWNLOAD_LOG_MAX_BYTES ("" per non salvarlo)
+DOWNLOAD_LOG_PATH = os.getenv("DOWNLOAD_LOG_PATH", "")
+DOWNLOAD_LOG_MAX_BYTES = int(os.getenv("DOWNLOAD_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+
+# Stati possibili di un job di download
+QUEUED = 'in coda'
+RUNNING = 'in corso'
+COMPLETED = 'completato'
+FAILED = 'errore'
+TIMED_OUT = 'timeout'
+CANCELLED = 'annullato'
+
+def build_spotdl_command(urls, output_dir, cookie_file=None, native=False):
+    """
+    Costruisce la riga di comando di spotdl per uno o piu' URL. Con
+    `native` lo stream viene salvato senza ricodifica (quando e' gia' opus,
+    il caso tipico di YouTube Music): la conversione la fa PostProcessor.
+    """
+    if isinstance(urls, str):
+        urls = [urls]
+    command = ['spotdl', *urls, '--format', 'opus', '--output', output_dir]
+    if native:
+        command.extend(['--bitrate', 'disable'])
+    if cookie_file and os.path.exists(cookie_file):
+        command.extend(['--cookie-file', cookie_file])
+    return command
+
+# Righe dell'output di spotdl che descrivono l'esito di una singola canzone
+_DOWNLOADED_RE = re.compile(r'^Downloaded "(?P<song>.+)": ')
+_SKIPPED_RE = re.compile(r'^Skipping (?P<song>.+?) \((?:file already exists|duplicate)')
+_ERROR_RE = re.compile(r'^(?P<error>\w*(?:Error|Exception)): (?P<message>.+)$')
+
+def parse_spotdl_line(line):
+    """
+    Interpreta una riga di output di spotdl.
+
+    Restituisce (esito, testo) con esito COMPLETED (scaricata o gia' presente)
+    o FAILED, oppure None se la riga non riguarda una singola canzone.
+    Per gli errori il testo e' il messaggio completo, da confrontare con i
+    nomi delle canzoni attese.
+    """
+    match = _DOWNLOADED_RE.match(line) or _SKIPPED_RE.match(line)
+    if match:
+        return COMPLETED, match.group('song')
+    match = _ERROR_RE.match(line)
+    if match:
+        return FAILED, line
+    return None
+
+def song_display_name(track):
+    """Nome "Artista - Titolo" con cui spotdl identifica una traccia Spotify."""
+    artists = track.get('artists') or []
+    artist = artists[0].get('name') if artists else ''
+    return f"{artist} - {track.get('name', '')}" if artist else track.get('name', '')
+
+def _song_key(stem):
+    """
+    Chiave "artista - titolo" (minuscola) di un nome di file di spotdl: con
+    piu' artisti spotdl li elenca tutti ("A, B - Titolo"), si tiene il primo
+    come in song_display_name.
+    """
+    # Caratteri che spotdl toglie o sostituisce nei nomi dei file
+    stem = ''.join(char for char in stem if char not in '/?\\*|<>')
+    stem = stem.replace('"', "'").replace(':', '-').strip().lower()
+    artists, separator, title = stem.partition(' - ')
+    if not separator:
+        return stem
+    return f"{artists.split(', ')[0]} - {title}"
+
+def existing_songs(output_dir):
+    """Chiavi (vedi _song_key) dei file audio gia' presenti in `output_dir`."""
+    try:
+        with os.scandir(output_dir) as entries:
+            return {
+                _song_key(os.path.splitext(entry.name)[0]) for entry in entries
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS
+            }
+    except OSError:
+        return set()
+
+class DownloadJob:
+    """
+    Un'invocazione di spotdl sottomessa al DownloadExecutor.
+
+    Un job puo' contenere piu' elementi (`items`, lista di (nome, url)):
+    vengono scaricati da un solo processo spotdl e l'esito di ciascuno
+    viene ricavato dall'output e salvato in `results` (url -> stato).
+    `weights` (url -> numero di tracce) indica quante tracce scarica un
+    elemento che non e' una singola traccia, come un album: il timeout del
+    job e' proporzionale al totale. on_result(job, url, stato) viene chiamata appena l'esito di un elemento
+    e' noto, senza aspettare la fine del processo. Dell'output restano in
+    memoria solo le ultime `DOWNLOAD_LOG_LINES` righe (`log`).
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, name, items, on_output=None, on_done=None, on_result=None, weights=None):
+        self.id = next(self._ids)
+        self.name = name
+        self.items = items
+        self.weights = weights or {}
+        self.results = {}
+        self.status = QUEUED
+        self.returncode = None
+        self.lines = 0
+        self.log = deque(maxlen=DOWNLOAD_LOG_LINES)
+        self.error = None
+        self.on_output = on_output
+        self.on_done = on_done
+        self.on_result = on_result
+        self.future = None
+        # Con la post-elaborazione: elementi scaricati, in attesa di arrivare nella libreria
+        self._staged = None
+        self._process = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return self.items[0][1]
+
+    @property
+    def urls(self):
+        return [url for _, url in self.items]
+
+    def track_count(self, urls=None):
+        """Tracce scaricate dagli elementi `urls` (di default tutti)."""
+        return sum(max(1, self.weights.get(url, 1)) for url in (self.urls if urls is None else urls))
+
+    @property
+    def last_line(self):
+        return self.log[-1] if self.log else ''
+
+    @property
+    def progress(self):
+        """Percentuale di elementi con un esito noto."""
+        return int(len(self.results) * 100 / len(self.items)) if self.items else 100
+
+    @property
+    def done(self):
+        return self.status in (COMPLETED, FAILED, TIMED_OUT, CANCELLED)
+
+    def cancel(self):
+        """Annulla il job: se e' in coda non partira', se e' in corso il processo viene terminato."""
+        self._cancelled.set()
+        with self._lock:
+            if self._process:
+                kill_process_tree(self._process)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'url': self.url,
+            'items': len(self.items),
+            'status': self.status,
+            'results': dict(self.results),
+            'returncode': self.returncode,
+            'progress': self.progress,
+            'lines': self.lines,
+            'last_line': self.last_line,
+            'log': list(self.log),
+            'error': self.error,
+        }
+
+class DownloadExecutor:
+    """
+    Esegue fino a `max_workers` processi spotdl in parallelo.
+
+    Ogni job ha un timeout reale (il processo viene terminato allo scadere,
+    anche se non produce output) e puo' essere annullato. I callback
+    on_output(job, line) e on_done(job) permettono al chiamante di seguire
+    l'avanzamento di ciascun job. Con la post-elaborazione gli esiti
+    positivi, on_done e `job.future` arrivano quando i file sono nella
+    libreria, non alla fine del processo spotdl.
+    """
+    def __init__(self, max_workers=DOWNLOAD_WORKERS, timeout=DOWNLOAD_TIMEOUT, output_dir=OUTPUT_DIR, cookie_file=None,
+                 postprocess=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.output_dir = output_dir
+        self.cookie_file = cookie_file
+        self.output_log = rotating_log(DOWNLOAD_LOG_PATH, DOWNLOAD_LOG_MAX_BYTES)
+        # Conversione e normalizzazione in un pool di processi separato (vedi postprocess.py)
+        if postprocess is None:
+            postprocess = postprocess_enabled()
+        self.postprocessor = PostProcessor(output_dir, on_file=self._library_file_added) if postprocess else None
+        # Chiavi dei brani gia' in `output_dir`, lette una volta e aggiornate a ogni file aggiunto
+        self._library_names = None
+        self._library_names_at = 0
+        self._library_names_lock = threading.Lock()
+        if self.postprocessor:
+            self.postprocessor.recover()
+        # Job non ancora terminati, per id (per l'annullamento)
+        self.jobs = {}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='spotdl')
+
+    def submit(self, name, url, on_output=None, on_done=None, on_result=None, tracks=1):
+        """
+        Mette in coda il download di `url` e restituisce il DownloadJob.
+        `tracks` e' il numero di tracce dell'URL (per un album), da cui
+        dipende il timeout.
+        """
+        return self.submit_batch(name, [(name, url)], on_output=on_output, on_done=on_done, on_result=on_result,
+                                 weights={url: tracks})
+
+    def submit_batch(self, name, items, on_output=None, on_done=None, on_result=None, weights=None):
+        """
+        Mette in coda un job che scarica tutti gli `items` (lista di
+        (nome, url)) con una sola invocazione di spotdl. I nomi devono essere
+        nella forma "Artista - Titolo" (vedi song_display_name) per poter
+        attribuire a ogni elemento il proprio esito.
+        """
+        job = DownloadJob(name, list(items), on_output=on_output, on_done=on_done, on_result=on_result, weights=weights)
+        self.jobs[job.id] = job
+        metrics.DOWNLOADS_PENDING.inc()
+        # Completato da _finish(): con la post-elaborazione, solo quando i file sono nella libreria
+        job.future = Future()
+        self._pool.submit(self._run, job)
+        return job
+
+    def submit_chunked(self, name, items, batch_size=BATCH_SIZE, on_output=None, on_done=None, on_result=None):
+        """Divide gli `items` in batch da `batch_size` e li sottomette; restituisce i job."""
+        items = list(items)
+        return [
+            self.submit_batch(f"{name} ({i // batch_size + 1})", items[i:i + batch_size], on_output=on_output,
+                              on_done=on_done, on_result=on_result)
+            for i in range(0, len(items), batch_size)
+        ]
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job:
+            job.cancel()
+        return job
+
+    def cancel_all(self):
+        for job in list(self.jobs.values()):
+            if not job.done:
+                job.cancel()
+
+    def wait(self, jobs):
+        """Attende la fine dei job indicati."""
+        wait([job.future for job in jobs])
+
+    def shutdown(self, cancel_pending=False):
+        if cancel_pending:
+            self.cancel_all()
+        self._pool.shutdown(wait=True)
+        if self.postprocessor:
+            self.postprocessor.shutdown()
+
+    def _run(self, job):
+        metrics.DOWNLOADS_PENDING.dec()
+        started = time.monotonic()
+        staging = None
+        try:
+            if job._cancelled.is_set():
+                job.status = CANCELLED
+                return job
+            metrics.DOWNLOADS_RUNNING.inc()
+            try:
+                staging = self._execute(job)
+            finally:
+                metrics.DOWNLOADS_RUNNING.dec()
+            elapsed = time.monotonic() - started
+            metrics.DOWNLOAD_BATCH_SECONDS.observe(elapsed)
+            metrics.DOWNLOAD_TRACK_SECONDS.observe(elapsed / job.track_count())
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(e)
+            # La cartella di staging resta a recover() del prossimo avvio: niente e' nella libreria
+            staged, job._staged = job._staged or [], None
+            for url in staged:
+                self._set_result(job, url, FAILED)
+            for _, url in job.items:
+                if url not in job.results:
+                    self._set_result(job, url, FAILED)
+        finally:
+            if staging:
+                # La conversione prosegue nel pool mentre questo worker passa al
+                # batch successivo; il job si chiude quando i file sono nella libreria
+                on_output = (lambda message: job.on_output(job, message)) if job.on_output else None
+                self.postprocessor.submit_dir(staging, keep_failed=(job.status == COMPLETED), on_output=on_output,
+                                              on_complete=lambda discarded: self._finish(job, discarded))
+            else:
+                self._finish(job)
+        return job
+
+    def _finish(self, job, discarded=0):
+        """
+        Chiude il job: comunica gli esiti rimandati dalla post-elaborazione
+        (falliti se qualche file e' stato scartato, perche' non si sa quale),
+        aggiorna le metriche e chiama on_done.
+        """
+        staged, job._staged = job._staged or [], None
+        for url in staged:
+            self._set_result(job, url, FAILED if discarded else COMPLETED)
+        try:
+            self.jobs.pop(job.id, None)
+            metrics.DOWNLOAD_BATCHES.inc(status=job.status)
+            for _, url in job.items:
+                metrics.DOWNLOAD_TRACKS.inc(status=job.results.get(url, job.status))
+            if job.on_done:
+                job.on_done(job)
+        finally:
+            job.future.set_result(job)
+
+    def _execute(self, job):
+        """Esegue spotdl; restituisce la cartella di staging da post-elaborare, se c'e'."""
+        staging = self.postprocessor.job_dir(job.id) if self.postprocessor else None
+        urls = job.urls
+        if staging:
+            urls = self._skip_existing(job)
+            if not urls:
+                self.postprocessor.remove_dir(staging)
+                job.status = COMPLETED
+                return None
+            job._staged = []
+        command = build_spotdl_command(urls, staging or self.output_dir, self.cookie_file, native=bool(staging))
+        # Il timeout e' per traccia: un batch (o un album) ha a disposizione il tempo di tutte
+        runner = StreamingProcess(command, timeout=self.timeout * job.track_count(urls),
+                                  on_line=lambda line: self._on_line(job, line))
+        with job._lock:
+            if job._cancelled.is_set():
+                job.status = CANCELLED
+                if staging:
+                    self.postprocessor.remove_dir(staging)
+                return None
+            try:
+                job._process = runner.start()
+            except OSError:
+                # spotdl mancante o non eseguibile
+                if staging:
+                    self.postprocessor.remove_dir(staging)
+                raise
+            job.status = RUNNING
+        runner.run()
+
+        job.returncode = runner.returncode
+        if runner.timed_out:
+            job.status = TIMED_OUT
+        elif job._cancelled.is_set():
+            job.status = CANCELLED
+        elif runner.returncode == 0:
+            job.status = COMPLETED
+        else:
+            job.status = FAILED
+
+        # Gli elementi senza una riga di esito prendono lo stato del processo
+        # (un batch terminato con successo li ha scaricati tutti)
+        for _, url in job.items:
+            if url not in job.results:
+                self._set_result(job, url, job.status)
+        return staging
+
+    def _skip_existing(self, job):
+        """
+        spotdl scrive nella cartella di staging, vuota, quindi non riconosce
+        i brani gia' nella libreria: le tracce con un file dallo stesso nome
+        in `output_dir` vengono segnate come completate senza scaricarle.
+        Restituisce gli URL da passare a spotdl.
+        """
+        existing = self._existing_songs()
+        urls = []
+        for name, url in job.items:
+            if track_id_from_url(url) and _song_key(name) in existing:
+                self._on_line(job, f"Gia' presente nella libreria, saltata: {name}")
+                self._set_result(job, url, COMPLETED)
+            else:
+                urls.append(url)
+        return urls
+
+    def _existing_songs(self):
+        """
+        Chiavi dei brani nella libreria. La cartella (una sola, con tutta la
+        libreria) viene letta al primo batch e poi ogni LIBRARY_NAMES_TTL
+        secondi, per vedere file aggiunti o rimossi da altri processi; nel
+        frattempo vi si aggiungono i file spostati dalla post-elaborazione.
+        """
+        with self._library_names_lock:
+            if self._library_names is None or time.monotonic() - self._library_names_at > LIBRARY_NAMES_TTL:
+                self._library_names = existing_songs(self.output_dir)
+                self._library_names_at = time.monotonic()
+            return self._library_names
+
+    def _library_file_added(self, path):
+        with self._library_names_lock:
+            if self._library_names is not None and os.path.dirname(path) == self.output_dir:
+                self._library_names.add(_song_key(os.path.splitext(os.path.basename(path))[0]))
+
+    def _on_line(self, job, line):
+        job.lines += 1
+        job.log.append(line)
+        if self.output_log:
+            self.output_log.info("[%s] %s", job.name, line)
+        self._record_result(job, line)
+        if job.on_output:
+            job.on_output(job, line)
+
+    def _set_result(self, job, url, status):
+        job.results[url] = status
+        if status == COMPLETED and job._staged is not None:
+            # Il file e' ancora in staging: l'esito arriva a on_result solo
+            # quando la post-elaborazione l'ha spostato nella libreria
+            job._staged.append(url)
+            return
+        if job.on_result:
+            try:
+                job.on_result(job, url, status)
+            except Exception as e:
+                # Un errore del chiamante non deve interrompere la lettura dell'output
+                print(f"Errore nel callback di esito per {url}: {e}")
+
+    def _record_result(self, job, line):
+        parsed = parse_spotdl_line(line)
+        if not parsed:
+            return
+        outcome, text = parsed
+        text = text.lower()
+        for name, url in job.items:
+            if url in job.results:
+                continue
+            if name.lower() == text or (outcome == FAILED and (name.lower() in text or url in line)):
+                self._set_result(job, url, outcome)
+                return
@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from urllib.parse import urlencode
+
+# Cartella per i file di stato persistenti (montata come volume nel container)
+DATA_DIR = os.getenv("DATA_DIR", "data")
+CACHE_PATH = os.getenv("SPOTIFY_CACHE_PATH", os.path.join(DATA_DIR, "spotify_cache.db"))
+CACHE_MAX_MB = int(os.getenv("SPOTIFY_CACHE_MAX_MB", "200"))
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# TTL per tipo di endpoint: la prima regola che corrisponde al percorso vince.
+# Tracklist e dettagli di album/tracce praticamente non cambiano; le
+# classifiche invece si aggiornano ogni giorno.
+TTL_RULES = [
+    (re.compile(r'/albums/[^/?]+/tracks'), 30 * DAY),
+    (re.compile(r'/albums(\?|$)'), 30 * DAY),
+    (re.compile(r'/tracks(\?|$)'), 30 * DAY),
+    (re.compile(r'/artists/[^/?]+/albums'), DAY),
+    (re.compile(r'/artists/[^/?]+/related-artists'), 7 * DAY),
+    (re.compile(r'/artists(\?|$)'), DAY),
+    (re.compile(r'/playlists/'), HOUR),
+    (re.compile(r'/search'), DAY),
+]
+DEFAULT_TTL = HOUR
+
+def ttl_for_url(url):
+    """Restituisce il TTL in secondi per l'URL indicato."""
+    for pattern, ttl in TTL_RULES:
+        if pattern.search(url):
+            return ttl
+    return DEFAULT_TTL
+
+def cache_key(url, params=None):
+    """Chiave di cache: URL piu' parametri in ordine stabile."""
+    if not params:
+        return url
+    separator = '&' if '?' in url else '?'
+    return url + separator + urlencode(sorted(params.items()))
+
+class HTTPCache:
+    """
+    Cache persistente su SQLite delle risposte JSON dell'API.
+
+    Ogni voce ha una scadenza calcolata dal TTL dell'endpoint e l'eventuale
+    ETag per la rivalidazione condizionale. La dimensione totale e' limitata:
+    oltre `max_bytes` vengono rimosse le voci usate meno di recente (LRU).
+    Il database e' in modalita' WAL, quindi puo' essere condiviso tra thread
+    (una connessione per thread) e tra processi (web e discover).
+    """
+    EVICTION_CHECK_EVERY = 100
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    etag TEXT,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    size INTEGER NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key):
+        """
+        Restituisce (dati, etag, fresco) oppure None se la chiave non e' in cache.
+        Una voce scaduta viene comunque restituita (fresco=False) per poterla
+        rivalidare con l'ETag.
+        """
+        conn = self._connection()
+        row = conn.execute("SELECT body, etag, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self._count('misses')
+            return None
+        body, etag, expires_at = row
+        fresh = time.time() < expires_at
+        if fresh:
+            self._count('hits')
+            with conn:
+                conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        else:
+            self._count('misses')
+        return json.loads(zlib.decompress(body)), etag, fresh
+
+    def set(self, key, data, etag=None, ttl=DEFAULT_TTL):
+        """Salva una risposta con la scadenza indicata."""
+        body = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, body, etag, expires_at, last_access, size) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, body, etag, now + ttl, now, len(body)),
+            )
+        # Contatore condiviso tra i thread del pool: incremento e controllo
+        # sotto lock, altrimenti il multiplo di EVICTION_CHECK_EVERY puo' saltare
+        with self._stats_lock:
+            self._writes += 1
+            check = self._writes % self.EVICTION_CHECK_EVERY == 0
+        if check:
+            self.evict()
+
+    def refresh(self, key, ttl=DEFAULT_TTL):
+        """Prolunga la validita' di una voce dopo un 304 Not Modified."""
+        self._count('revalidations')
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("UPDATE responses SET expires_at = ?, last_access = ? WHERE key = ?", (now + ttl, now, key))
+
+    def evict(self):
+        """Rimuove le voci meno usate finche' la cache non scende al 90% del limite."""
+        conn = self._connection()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        to_free = total - int(self.max_bytes * 0.9)
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            keys.append((key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+        with conn:
+            conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        with self._stats_lock:
+            self.evictions += len(keys)
+        return len(keys)
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM responses")
+
+    def stats(self):
+        """Contatori di efficacia della cache (per questo processo) e occupazione."""
+        conn = self._connection()
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'entries': entries,
+            'size_bytes': size,
+        }
@@ -0,0 +1,339 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from collections import OrderedDict
+from http_cache import DATA_DIR
+from status_log import StatusLog
+
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", os.path.join(DATA_DIR, "jobs.db"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Un job in corso il cui processo non aggiorna il battito da piu' di
+# JOB_LEASE_SECONDS viene considerato abbandonato e rimesso in coda
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_SECONDS = max(1, JOB_LEASE_SECONDS // 4)
+
+# Stati di un job della coda
+JOB_QUEUED = 'in coda'
+JOB_RUNNING = 'in corso'
+JOB_COMPLETED = 'completato'
+JOB_CANCELLED = 'annullato'
+JOB_FAILED = 'errore'
+FINAL_STATES = (JOB_COMPLETED, JOB_CANCELLED, JOB_FAILED)
+
+# Job terminati di cui teniamo in memoria anche il log
+FINISHED_JOBS_IN_MEMORY = 50
+
+class QueuedJob:
+    """
+    Un download richiesto dall'utente: una lista di elementi
+    (tipo, nome, url, track_ids) con il proprio stato e il proprio log.
+    """
+    def __init__(self, id, title, items, priority=0, state=JOB_QUEUED, done_urls=(),
+                 created_at=None, started_at=None, finished_at=None, completed_items=0):
+        self.id = id
+        self.title = title
+        self.items = [tuple(item) for item in items]
+        self.priority = priority
+        self.state = state
+        self.done_urls = set(done_urls)
+        self.created_at = created_at or time.time()
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.total_items = len(self.items)
+        self.completed_items = completed_items
+        self.progress = 100 if state in FINAL_STATES else self._progress()
+        self.status_messages = StatusLog()
+        # Job del DownloadExecutor in corso, per poterli annullare
+        self.download_jobs = []
+        self._cancelled = threading.Event()
+
+    def _progress(self):
+        if not self.total_items:
+            return 0
+        # Il 100% arriva solo a job terminato, con il messaggio finale
+        return min(99, int(self.completed_items / self.total_items * 100))
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def pending_items(self):
+        """Elementi non ancora scaricati (quelli completati prima di un riavvio sono esclusi)."""
+        return [item for item in self.items if item[2] not in self.done_urls]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'priority': self.priority,
+            'state': self.state,
+            'progress': self.progress,
+            'total_items': self.total_items,
+            'completed_items': self.completed_items,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+class JobQueue:
+    """
+    Coda persistente dei download con priorita' e numero limitato di worker.
+
+    I job sono salvati in SQLite: dopo un riavvio del container i job in coda
+    ripartono e quelli interrotti a meta' riprendono dagli elementi non ancora
+    completati. `runner(queue, job)` esegue un job; deve chiamare
+    item_done() per ogni elemento terminato e controllare job.cancelled.
+
+    Un job in corso appartiene al processo che l'ha preso (`owner`, host e
+    pid), che ne aggiorna `heartbeat_at` ogni JOB_HEARTBEAT_SECONDS: un altro
+    processo sullo stesso database lo rimette in coda solo quando il battito
+    e' fermo da piu' di JOB_LEASE_SECONDS.
+    """
+    def __init__(self, runner, path=JOB_QUEUE_PATH, workers=JOB_WORKERS):
+        self.runner = runner
+        self.path = path
+        self.workers = workers
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._threads = []
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    title TEXT NOT NULL,
+                    items TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    state TEXT NOT NULL,
+                    done_urls TEXT NOT NULL DEFAULT '[]',
+                    completed_items INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    owner TEXT,
+                    heartbeat_at REAL
+                )"""
+            )
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (('owner', 'TEXT'), ('heartbeat_at', 'REAL')):
+                if column not in columns:
+                    # Database creato da una versione precedente
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority DESC, id)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def start(self):
+        """Rimette in coda i job interrotti e avvia i worker e il battito."""
+        # I job registrati con il nostro stesso owner sono di un'esecuzione
+        # precedente (nel container il pid si ripete): nessuno li sta eseguendo
+        resumed = self._connection().execute(
+            "UPDATE jobs SET state = ?, owner = NULL WHERE state = ? AND owner = ?",
+            (JOB_QUEUED, JOB_RUNNING, self.owner),
+        ).rowcount
+        resumed += self._requeue_expired()
+        if resumed:
+            print(f">>> {resumed} download interrotti rimessi in coda. <<<")
+        heartbeat = threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _requeue_expired(self):
+        """Rimette in coda i job in corso il cui processo ha smesso di aggiornare il battito."""
+        return self._connection().execute(
+            """UPDATE jobs SET state = ?, owner = NULL
+               WHERE state = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)""",
+            (JOB_QUEUED, JOB_RUNNING, time.time() - JOB_LEASE_SECONDS),
+        ).rowcount
+
+    def _heartbeat(self):
+        while True:
+            try:
+                self._connection().execute(
+                    "UPDATE jobs SET heartbeat_at = ? WHERE state = ? AND owner = ?",
+                    (time.time(), JOB_RUNNING, self.owner),
+                )
+                resumed = self._requeue_expired()
+                if resumed:
+                    print(f">>> {resumed} download abbandonati da un altro processo rimessi in coda. <<<")
+                    with self._wakeup:
+                        self._wakeup.notify_all()
+            except sqlite3.Error as e:
+                print(f"Errore nell'aggiornamento dei job in corso: {e}")
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+
+    def submit(self, title, items, priority=0):
+        """Aggiunge un job alla coda e restituisce il QueuedJob."""
+        now = time.time()
+        conn = self._connection()
+        cursor = conn.execute(
+            "INSERT INTO jobs (title, items, priority, state, created_at) VALUES (?, ?, ?, ?, ?)",
+            (title, json.dumps([list(item) for item in items]), priority, JOB_QUEUED, now),
+        )
+        job = QueuedJob(cursor.lastrowid, title, items, priority=priority, created_at=now)
+        job.status_messages.append(f"Download in coda (priorita' {priority})...")
+        self._remember(job)
+        with self._wakeup:
+            self._wakeup.notify()
+        return job
+
+    def get(self, job_id):
+        """
+        Restituisce il job (con il log, se e' ancora in memoria) o None. Un
+        job non ancora terminato letto dal database viene tenuto in memoria,
+        cosi' chi lo segue (pagina di stato, stream) e il worker che lo
+        esegue usano lo stesso oggetto e lo stesso log.
+        """
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return job
+            row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = self._from_row(row)
+            if job.state not in FINAL_STATES:
+                self._remember_locked(job)
+            return job
+
+    def latest(self):
+        row = self._connection().execute("SELECT id FROM jobs ORDER BY id DESC LIMIT 1").fetchone()
+        return self.get(row['id']) if row else None
+
+    def list(self, limit=50):
+        """Gli ultimi `limit` job, dal piu' recente."""
+        rows = self._connection().execute("SELECT id FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [self.get(row['id']) for row in rows]
+
+    def count(self, state=JOB_QUEUED):
+        """Numero di job nello stato indicato."""
+        return self._connection().execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (state,)).fetchone()[0]
+
+    def cancel(self, job_id):
+        """Annulla un job in coda o in corso. Restituisce il job, o None se non esiste."""
+        job = self.get(job_id)
+        if job is None or job.state in FINAL_STATES:
+            return job
+        job._cancelled.set()
+        for download_job in list(job.download_jobs):
+            download_job.cancel()
+        # Un job ancora in coda viene chiuso subito; uno in corso lo chiude il suo worker
+        conn = self._connection()
+        updated = conn.execute(
+            "UPDATE jobs SET state = ?, finished_at = ? WHERE id = ? AND state = ?",
+            (JOB_CANCELLED, time.time(), job_id, JOB_QUEUED),
+        ).rowcount
+        if updated:
+            job.state = JOB_CANCELLED
+            job.progress = 100
+            job.status_messages.append("Download annullato.")
+        return job
+
+    def item_done(self, job, url):
+        """Registra un elemento terminato (con o senza successo), anche su disco."""
+        with self._jobs_lock:
+            job.done_urls.add(url)
+            job.completed_items = len(job.done_urls)
+            job.progress = job._progress()
+            done_urls = json.dumps(sorted(job.done_urls))
+        self._connection().execute(
+            "UPDATE jobs SET done_urls = ?, completed_items = ? WHERE id = ?",
+            (done_urls, job.completed_items, job.id),
+        )
+        job.status_messages.notify()
+
+    def _claim_next(self):
+        """Prende in carico il job in coda con priorita' piu' alta (sicuro anche tra processi)."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE state = ? ORDER BY priority DESC, id LIMIT 1", (JOB_QUEUED,)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            started_at = time.time()
+            conn.execute(
+                "UPDATE jobs SET state = ?, started_at = ?, owner = ?, heartbeat_at = ? WHERE id = ?",
+                (JOB_RUNNING, started_at, self.owner, started_at, row['id']),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        job = self.get(row['id'])
+        job.state = JOB_RUNNING
+        job.started_at = started_at
+        self._remember(job)
+        return job
+
+    def _worker(self):
+        while True:
+            job = self._claim_next()
+            if job is None:
+                with self._wakeup:
+                    # Il timeout copre i job aggiunti da altri processi
+                    self._wakeup.wait(timeout=5)
+                continue
+            state = JOB_COMPLETED
+            try:
+                self.runner(self, job)
+            except Exception as e:
+                job.status_messages.append(f"ERRORE CRITICO: {e}")
+                state = JOB_FAILED
+            if job.cancelled:
+                state = JOB_CANCELLED
+            self._finish(job, state)
+
+    def _finish(self, job, state):
+        job.finished_at = time.time()
+        self._connection().execute(
+            "UPDATE jobs SET state = ?, finished_at = ? WHERE id = ?", (state, job.finished_at, job.id)
+        )
+        job.download_jobs = []
+        job.state = state
+        job.progress = 100
+        job.status_messages.notify()
+
+    def _remember(self, job):
+        with self._jobs_lock:
+            self._remember_locked(job)
+
+    def _remember_locked(self, job):
+        self._jobs[job.id] = job
+        self._jobs.move_to_end(job.id)
+        finished = [job_id for job_id, j in self._jobs.items() if j.state in FINAL_STATES]
+        for job_id in finished[:max(0, len(finished) - FINISHED_JOBS_IN_MEMORY)]:
+            del self._jobs[job_id]
+
+    def _from_row(self, row):
+        job = QueuedJob(
+            row['id'], row['title'], json.loads(row['items']), priority=row['priority'], state=row['state'],
+            done_urls=json.loads(row['done_urls']), created_at=row['created_at'], started_at=row['started_at'],
+            finished_at=row['finished_at'], completed_items=row['completed_items'],
+        )
+        if job.done_urls:
+            job.status_messages.append(f"Ripresa: {len(job.done_urls)}/{job.total_items} elementi gia' completati.")
+        return job
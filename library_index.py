@@ -0,0 +1,219 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from http_cache import DATA_DIR
+
+try:
+    import mutagen
+except ImportError:  # mutagen arriva con spotdl; senza, l'indice usa solo i download registrati
+    mutagen = None
+
+LIBRARY_INDEX_PATH = os.getenv("LIBRARY_INDEX_PATH", os.path.join(DATA_DIR, "library_index.db"))
+AUDIO_EXTENSIONS = {'.opus', '.mp3', '.m4a', '.flac', '.ogg', '.wav'}
+
+_TRACK_URL_RE = re.compile(r'open\.spotify\.com/(?:intl-\w+/)?track/([A-Za-z0-9]{22})')
+_ISRC_RE = re.compile(r'^[A-Z]{2}[A-Z0-9]{3}\d{7}$')
+
+def track_id_from_url(url):
+    """Estrae l'ID Spotify da un URL di traccia, o None."""
+    match = _TRACK_URL_RE.search(url or '')
+    return match.group(1) if match else None
+
+def read_file_ids(path):
+    """
+    Legge dai tag di un file audio (track_id, isrc). spotdl salva l'URL
+    Spotify della traccia e l'ISRC nei metadati; senza mutagen restituisce
+    (None, None).
+    """
+    if mutagen is None:
+        return None, None
+    try:
+        audio = mutagen.File(path)
+    except Exception:
+        return None, None
+    if audio is None or not audio.tags:
+        return None, None
+    track_id = isrc = None
+    items = audio.tags.items() if hasattr(audio.tags, 'items') else audio.tags
+    for key, value in items:
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            text = v.decode('utf-8', 'ignore') if isinstance(v, bytes) else str(v)
+            if track_id is None:
+                track_id = track_id_from_url(text)
+            if isrc is None and ('isrc' in str(key).lower() or str(key).startswith('TSRC')):
+                candidate = text.strip().upper()
+                if _ISRC_RE.match(candidate):
+                    isrc = candidate
+    return track_id, isrc
+
+class LibraryIndex:
+    """
+    Indice persistente dei brani gia' presenti nella libreria musicale.
+
+    Mappa ID Spotify e ISRC ai file su disco. Viene popolato in due modi:
+    - scan(): visita la cartella della musica e legge i tag solo dei file
+      nuovi o modificati (confronto su mtime e dimensione); lavora un
+      file alla volta, quindi la memoria non cresce con la libreria
+      nemmeno quando e' tutta in una cartella;
+    - mark_downloaded(): registra le tracce appena scaricate con successo.
+
+    I download registrati sono solo un'indicazione provvisoria, valida fino
+    alla scansione successiva: a quel punto i file sono indicizzati dai tag
+    e le registrazioni precedenti alla scansione vengono rimosse, cosi' un
+    file cancellato o spostato torna a essere scaricabile.
+    """
+    SCAN_COMMIT_EVERY = 500
+
+    def __init__(self, path=LIBRARY_INDEX_PATH, music_dir="/app/music"):
+        self.path = path
+        self.music_dir = music_dir
+        self._local = threading.local()
+        self._scan_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    dir TEXT NOT NULL,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    track_id TEXT,
+                    isrc TEXT,
+                    scan_gen INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+            if 'scan_gen' not in {row[1] for row in conn.execute("PRAGMA table_info(files)")}:
+                # Indice creato da una versione precedente
+                conn.execute("ALTER TABLE files ADD COLUMN scan_gen INTEGER NOT NULL DEFAULT 0")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS downloaded (
+                    track_id TEXT PRIMARY KEY,
+                    isrc TEXT,
+                    downloaded_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_track_id ON files (track_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_isrc ON files (isrc)")
+            conn.execute("CREATE INDEX IF NOT EXISTS downloaded_isrc ON downloaded (isrc)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def scan(self):
+        """
+        Aggiorna l'indice con il contenuto di `music_dir`. Restituisce un
+        dizionario con il numero di file visti, (re)indicizzati e rimossi.
+        """
+        if not os.path.isdir(self.music_dir):
+            return {'seen': 0, 'indexed': 0, 'removed': 0}
+        with self._scan_lock:
+            return self._scan()
+
+    def _scan(self):
+        started = time.time()
+        conn = self._connection()
+        # Ogni scansione ha un numero di generazione: i file visti ricevono
+        # quello corrente, quelli rimasti con una generazione precedente non
+        # esistono piu'. MAX() tiene la generazione piu' recente se un altro
+        # processo sta scansionando insieme a noi.
+        generation = conn.execute("SELECT COALESCE(MAX(scan_gen), 0) + 1 FROM files").fetchone()[0]
+        seen = indexed = pending = 0
+        stack = [self.music_dir]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = os.scandir(directory)
+            except OSError:
+                continue
+            # scandir e' letto man mano e ogni file viene confrontato con la
+            # sua riga: la memoria non dipende dal numero di file in una cartella
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith('.'):
+                                stack.append(entry.path)
+                            continue
+                        if os.path.splitext(entry.name)[1].lower() not in AUDIO_EXTENSIONS:
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    seen += 1
+                    pending += 1
+                    previous = conn.execute("SELECT mtime, size FROM files WHERE path = ?", (entry.path,)).fetchone()
+                    if previous == (stat.st_mtime, stat.st_size):
+                        conn.execute("UPDATE files SET scan_gen = MAX(scan_gen, ?) WHERE path = ?", (generation, entry.path))
+                    else:
+                        track_id, isrc = read_file_ids(entry.path)
+                        conn.execute(
+                            """INSERT INTO files (path, dir, mtime, size, track_id, isrc, scan_gen) VALUES (?, ?, ?, ?, ?, ?, ?)
+                               ON CONFLICT (path) DO UPDATE SET
+                                   mtime = excluded.mtime, size = excluded.size, track_id = excluded.track_id,
+                                   isrc = excluded.isrc, scan_gen = MAX(files.scan_gen, excluded.scan_gen)""",
+                            (entry.path, directory, stat.st_mtime, stat.st_size, track_id, isrc, generation),
+                        )
+                        indexed += 1
+                    if pending >= self.SCAN_COMMIT_EVERY:
+                        conn.commit()
+                        pending = 0
+        removed = conn.execute("DELETE FROM files WHERE scan_gen < ?", (generation,)).rowcount
+        if mutagen is not None:
+            # Ora i file presenti sono nell'indice con i loro tag: le
+            # registrazioni precedenti alla scansione non servono piu' (e
+            # quelle di file cancellati non devono bloccare un nuovo download).
+            # Senza mutagen i tag non si leggono e restano l'unica traccia.
+            conn.execute("DELETE FROM downloaded WHERE downloaded_at < ?", (started,))
+        conn.commit()
+        return {'seen': seen, 'indexed': indexed, 'removed': removed}
+
+    def has_track(self, track_id=None, isrc=None):
+        """True se la traccia (per ID Spotify o ISRC) e' gia' nella libreria."""
+        conn = self._connection()
+        if track_id:
+            if conn.execute("SELECT 1 FROM downloaded WHERE track_id = ?", (track_id,)).fetchone():
+                return True
+            if conn.execute("SELECT 1 FROM files WHERE track_id = ? LIMIT 1", (track_id,)).fetchone():
+                return True
+        if isrc:
+            if conn.execute("SELECT 1 FROM downloaded WHERE isrc = ? LIMIT 1", (isrc,)).fetchone():
+                return True
+            if conn.execute("SELECT 1 FROM files WHERE isrc = ? LIMIT 1", (isrc,)).fetchone():
+                return True
+        return False
+
+    def has_url(self, url):
+        return self.has_track(track_id=track_id_from_url(url))
+
+    def mark_downloaded(self, track_ids, isrcs=None):
+        """Registra come scaricate le tracce indicate (ID Spotify, ISRC opzionali)."""
+        isrcs = isrcs or {}
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                """INSERT INTO downloaded (track_id, isrc, downloaded_at) VALUES (?, ?, ?)
+                   ON CONFLICT (track_id) DO UPDATE SET
+                       isrc = COALESCE(excluded.isrc, downloaded.isrc),
+                       downloaded_at = excluded.downloaded_at""",
+                [(track_id, isrcs.get(track_id), now) for track_id in track_ids if track_id],
+            )
+
+    def stats(self):
+        conn = self._connection()
+        files = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        downloaded = conn.execute("SELECT COUNT(*) FROM downloaded").fetchone()[0]
+        return {'files': files, 'downloaded': downloaded}
@@ -0,0 +1,250 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Limiti (in secondi) dei bucket degli istogrammi di durata
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_ENDPOINT_ID_RE = re.compile(r'/(artists|albums|tracks|playlists|users)/[^/?]+')
+
+def endpoint_name(url):
+    """Nome dell'endpoint per le etichette: '/artists/{id}/albums' invece dell'URL completo."""
+    path = url.split('?', 1)[0]
+    path = path[path.find('/v1/') + 3:] if '/v1/' in path else path
+    return _ENDPOINT_ID_RE.sub(r'/\1/{id}', path)
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Etichette di {self.name}: attese {self.labelnames}, ricevute {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Restituisce [(suffisso, etichette extra, chiave, valore)] per l'esposizione."""
+        with self._lock:
+            return [('', (), key, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, extra, key, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}')
+        return lines
+
+class Counter(_Metric):
+    """Contatore monotono (richieste, errori, tracce scaricate...)."""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+    def values(self):
+        """{chiave etichette: valore} di tutte le serie."""
+        with self._lock:
+            return dict(self._values)
+
+class Gauge(_Metric):
+    """Valore istantaneo (download in corso, profondita' delle code...)."""
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Il valore viene letto da `function()` a ogni esposizione (solo gauge senza etichette)."""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                return [('', (), (), self._function())]
+            except Exception:
+                return []
+        return super().samples()
+
+class Histogram(_Metric):
+    """Distribuzione di durate in bucket cumulativi, con somma e conteggio."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def series(self):
+        """{chiave etichette: (conteggio, somma, conteggi per bucket)}."""
+        with self._lock:
+            return {key: (s['count'], s['sum'], list(s['counts'])) for key, s in self._values.items()}
+
+    def quantile(self, q, key=None):
+        """Stima del quantile `q` dai bucket (limite superiore del bucket), su una serie o su tutte."""
+        all_series = self.series()
+        series = [all_series[key]] if key is not None else list(all_series.values())
+        counts = [sum(s[2][i] for s in series) for i in range(len(self.buckets))]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def samples(self):
+        samples = []
+        for key, (count, total, counts) in sorted(self.series().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', (('le', _format_value(bound)),), key, cumulative))
+            samples.append(('_sum', (), key, total))
+            samples.append(('_count', (), key, count))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """Tutte le metriche nel formato testuale di Prometheus."""
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+REGISTRY = Registry()
+
+# --- API di Spotify ---
+API_REQUESTS = Counter('spotify_api_requests_total', "Richieste all'API di Spotify per endpoint ed esito.",
+                       ('endpoint', 'status'))
+API_LATENCY = Histogram('spotify_api_request_seconds', "Durata delle richieste HTTP all'API di Spotify.",
+                        ('endpoint',), buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+API_RETRIES = Counter('spotify_api_retries_total', "Tentativi ripetuti per endpoint e motivo.", ('endpoint', 'reason'))
+TOKEN_REFRESHES = Counter('spotify_token_refreshes_total', "Rinnovi del token di accesso (condiviso = letto dal file di un altro processo).", ('result',))
+RATE_LIMIT = Gauge('spotify_rate_limit', "Richieste/secondo consentite ora dal rate limiter.")
+
+# --- Download con spotdl ---
+DOWNLOAD_BATCHES = Counter('spotdl_batches_total', "Processi spotdl terminati, per esito.", ('status',))
+DOWNLOAD_TRACKS = Counter('spotdl_tracks_total', "Elementi (tracce o album) scaricati, per esito.", ('status',))
+DOWNLOAD_BATCH_SECONDS = Histogram('spotdl_batch_seconds', "Durata di un processo spotdl.")
+DOWNLOAD_TRACK_SECONDS = Histogram('spotdl_track_seconds', "Durata media per elemento di un processo spotdl.")
+DOWNLOADS_RUNNING = Gauge('spotdl_running', "Processi spotdl in esecuzione.")
+DOWNLOADS_PENDING = Gauge('spotdl_pending', "Batch in attesa di un processo spotdl.")
+POSTPROCESS_FILES = Counter('postprocess_files_total', "File convertiti e normalizzati dopo il download, per esito.",
+                            ('status',))
+POSTPROCESS_SECONDS = Histogram('postprocess_file_seconds', "Attesa ed elaborazione di un file nel pool di post-elaborazione.",
+                                buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+POSTPROCESS_PENDING = Gauge('postprocess_pending', "File in coda o in elaborazione nel pool di post-elaborazione.")
+JOBS_QUEUED = Gauge('download_jobs_queued', "Job della coda dei download in attesa.")
+
+def _quantile_text(histogram, q, key=None, scale=1, unit='s'):
+    """Quantile come "<= limite"; oltre l'ultimo bucket come "> ultimo bucket"."""
+    bound = histogram.quantile(q, key)
+    if bound == float('inf'):
+        return f"> {histogram.buckets[-2] * scale:g}{unit}"
+    return f"<= {bound * scale:g}{unit}"
+
+def summary():
+    """Righe di riepilogo leggibili delle metriche principali, per la fine di discover.py."""
+    lines = []
+    requests_by_endpoint = {}
+    for (endpoint, status), value in API_REQUESTS.values().items():
+        requests_by_endpoint.setdefault(endpoint, {})[status] = value
+    latency = API_LATENCY.series()
+    for endpoint, statuses in sorted(requests_by_endpoint.items()):
+        count, total, _ = latency.get((endpoint,), (0, 0.0, None))
+        detail = ', '.join(f'{status}: {value}' for status, value in sorted(statuses.items()))
+        average = f", media {total / count * 1000:.0f}ms, p95 {_quantile_text(API_LATENCY, 0.95, (endpoint,), 1000, 'ms')}" if count else ''
+        lines.append(f"API {endpoint}: {sum(statuses.values())} richieste ({detail}){average}")
+    retries = API_RETRIES.total()
+    if retries:
+        lines.append(f"API: {retries} tentativi ripetuti, {TOKEN_REFRESHES.total()} rinnovi del token.")
+    batches = DOWNLOAD_BATCH_SECONDS.series().get(())
+    if batches:
+        tracks = {status: value for (status,), value in DOWNLOAD_TRACKS.values().items()}
+        total_tracks = sum(tracks.values())
+        failed = total_tracks - tracks.get('completato', 0)
+        lines.append(
+            f"spotdl: {batches[0]} processi, {total_tracks} elementi, "
+            f"{failed / total_tracks:.0%} non riusciti, {batches[1] / batches[0]:.1f}s medi per processo, "
+            f"p95 per elemento {_quantile_text(DOWNLOAD_TRACK_SECONDS, 0.95)}."
+            if total_tracks else f"spotdl: {batches[0]} processi."
+        )
+    processed = POSTPROCESS_SECONDS.series().get(())
+    if processed:
+        failed = POSTPROCESS_FILES.values().get(('errore',), 0)
+        lines.append(f"Post-elaborazione: {processed[0]} file ({failed} non riusciti), "
+                     f"{processed[1] / processed[0]:.1f}s medi per file.")
+    return lines
@@ -0,0 +1,140 @@
+import queue
+import threading
+import time
+from downloader import BATCH_SIZE
+
+class DownloadPipeline:
+    """
+    Pipeline produttore/consumatore per scaricare gli artisti man mano che
+    vengono scoperti, invece di aspettare la fine della scoperta:
+
+        scoperta --add_artist()--> [artisti] --expand()--> [batch, coda limitata] --> DownloadExecutor
+
+    `expand(artist_id, releases)` gira in un thread dedicato mentre i batch
+    precedenti vengono scaricati e restituisce (release, batch), dove ogni
+    batch e' (nome, items). La coda dei batch e' limitata e nell'executor ci
+    sono al massimo `max_workers` batch alla volta: se spotdl e' piu' lento
+    dell'API, l'espansione si ferma invece di accumulare lavoro in memoria.
+
+    `on_result(artist_id, job, url, stato)` viene chiamata appena l'esito di
+    una traccia e' noto, `on_batch_done(job)` alla fine di ogni batch,
+    `on_artist_done(artist_id, releases)` quando tutti i batch di un artista
+    sono terminati (o subito, se non c'e' niente da scaricare).
+    """
+    def __init__(self, executor, expand, on_artist_done=None, on_batch_done=None, on_result=None, queue_size=None,
+                 batch_size=BATCH_SIZE):
+        self.executor = executor
+        self.expand = expand
+        self.on_artist_done = on_artist_done
+        self.on_batch_done = on_batch_done
+        self.on_result = on_result
+        self.batch_size = batch_size
+        self._artists = queue.Queue()
+        self._batches = queue.Queue(maxsize=queue_size or executor.max_workers * 2)
+        self._slots = threading.Semaphore(executor.max_workers)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._seen = set()
+        self._expander = threading.Thread(target=self._expand_worker, name='pipeline-expand', daemon=True)
+        self.started_at = time.monotonic()
+        self.first_download_at = None
+        self.artists_expanded = 0
+        self.batches_submitted = 0
+        self.tracks_submitted = 0
+
+    def start(self):
+        self._expander.start()
+        return self
+
+    def add_artist(self, artist_id, releases=None):
+        """Accoda un artista (thread-safe). Con `releases` si scaricano solo quelle."""
+        self._artists.put((artist_id, releases))
+
+    def close(self):
+        """Segnala che non arriveranno altri artisti."""
+        self._artists.put(None)
+
+    def _expand_worker(self):
+        try:
+            while True:
+                entry = self._artists.get()
+                if entry is None:
+                    break
+                artist_id, releases = entry
+                if artist_id in self._seen:
+                    continue
+                self._seen.add(artist_id)
+                try:
+                    releases, batches = self.expand(artist_id, releases)
+                except Exception as e:
+                    print(f"ERRORE durante l'espansione dell'artista {artist_id}: {e}")
+                    continue
+                self.artists_expanded += 1
+
+                chunks = [
+                    (f"{name} ({i // self.batch_size + 1})", items[i:i + self.batch_size])
+                    for name, items in batches
+                    for i in range(0, len(items), self.batch_size)
+                ]
+                if not chunks:
+                    self._artist_done(artist_id, releases)
+                    continue
+                with self._lock:
+                    self._pending[artist_id] = [len(chunks), releases]
+                for name, items in chunks:
+                    # Blocca finche' i downloader non liberano posto nella coda
+                    self._batches.put((artist_id, name, items))
+        finally:
+            self._batches.put(None)
+
+    def run(self):
+        """
+        Sottomette i batch all'executor man mano che arrivano. Ritorna quando
+        la scoperta e' chiusa e tutti i batch sono terminati.
+        """
+        while True:
+            entry = self._batches.get()
+            if entry is None:
+                break
+            artist_id, name, items = entry
+            self._slots.acquire()
+            if self.first_download_at is None:
+                self.first_download_at = time.monotonic()
+                print(f">>> Primo download avviato dopo {self.first_download_at - self.started_at:.1f}s. <<<")
+            on_result = None
+            if self.on_result:
+                on_result = lambda job, url, status, artist_id=artist_id: self.on_result(artist_id, job, url, status)
+            self.executor.submit_batch(
+                name, items, on_done=lambda job, artist_id=artist_id: self._batch_done(artist_id, job),
+                on_result=on_result,
+            )
+            self.batches_submitted += 1
+            self.tracks_submitted += len(items)
+        # Tutti gli slot liberi = nessun batch ancora in corso
+        for _ in range(self.executor.max_workers):
+            self._slots.acquire()
+        for _ in range(self.executor.max_workers):
+            self._slots.release()
+        self._expander.join()
+
+    def _batch_done(self, artist_id, job):
+        try:
+            if self.on_batch_done:
+                self.on_batch_done(job)
+            with self._lock:
+                pending = self._pending[artist_id]
+                pending[0] -= 1
+                finished = pending[0] == 0
+                if finished:
+                    del self._pending[artist_id]
+            if finished:
+                self._artist_done(artist_id, pending[1])
+        finally:
+            self._slots.release()
+
+    def _artist_done(self, artist_id, releases):
+        if self.on_artist_done:
+            try:
+                self.on_artist_done(artist_id, releases)
+            except Exception as e:
+                print(f"ERRORE al termine dell'artista {artist_id}: {e}")
@@ -0,0 +1,339 @@
+import os
+import time
+import base64
+import shutil
+import tempfile
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+try:
+    import mutagen
+    from mutagen.flac import Picture
+    from mutagen.mp4 import MP4Cover
+except ImportError:  # mutagen arriva con spotdl; senza, opus e ogg restano senza copertina
+    mutagen = None
+
+try:
+    import fcntl
+except ImportError:  # Solo Windows: le cartelle di staging abbandonate non vengono recuperate
+    fcntl = None
+
+# Post-elaborazione dei file scaricati: conversione, normalizzazione del
+# volume e tag, in un pool di processi ffmpeg separato dai download.
+# POSTPROCESS=0 la disattiva (spotdl converte da se', come in passato);
+# senza ffmpeg nel PATH e' sempre disattivata.
+POSTPROCESS = os.getenv("POSTPROCESS", "1") == "1"
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", str(os.cpu_count() or 1)))
+POSTPROCESS_FORMAT = os.getenv("POSTPROCESS_FORMAT", "opus")
+POSTPROCESS_BITRATE = os.getenv("POSTPROCESS_BITRATE", "160k")
+# Filtro loudnorm di ffmpeg (EBU R128); vuoto per non normalizzare
+POSTPROCESS_LOUDNORM = os.getenv("POSTPROCESS_LOUDNORM", "I=-14:TP=-1.5:LRA=11")
+POSTPROCESS_TIMEOUT = int(os.getenv("POSTPROCESS_TIMEOUT", "600"))
+# Cartella dei file appena scaricati, dentro quella di output (stesso filesystem)
+STAGING_DIRNAME = ".staging"
+# File di lock che il processo proprietario tiene aperto in ogni cartella di staging
+OWNER_LOCK = ".owner"
+
+# Codec ffmpeg per formato di uscita; i formati con la copertina come
+# stream video (mp3, m4a, flac) la copiano cosi' com'e', per opus e ogg la
+# copia copy_cover() dopo la conversione
+_CODECS = {
+    'opus': ('libopus', False),
+    'ogg': ('libvorbis', False),
+    'mp3': ('libmp3lame', True),
+    'm4a': ('aac', True),
+    'flac': ('flac', True),
+}
+_AUDIO_EXTENSIONS = ('.opus', '.ogg', '.webm', '.m4a', '.mp3', '.flac', '.wav')
+
+def postprocess_enabled():
+    return POSTPROCESS and shutil.which('ffmpeg') is not None
+
+def build_ffmpeg_command(source, target, audio_format=POSTPROCESS_FORMAT, bitrate=POSTPROCESS_BITRATE,
+                         loudnorm=POSTPROCESS_LOUDNORM):
+    """Riga di comando di ffmpeg per convertire `source` in `target` mantenendo tag e copertina."""
+    codec, cover_stream = _CODECS[audio_format]
+    # Un core per processo: il pool ne esegue uno per core
+    command = ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-threads', '1', '-y',
+               '-i', source, '-map', '0:a']
+    if cover_stream:
+        command += ['-map', '0:v?', '-c:v', 'copy', '-disposition:v', 'attached_pic']
+    if loudnorm:
+        command += ['-af', f'loudnorm={loudnorm}']
+    command += ['-c:a', codec]
+    if codec != 'flac' and bitrate:
+        command += ['-b:a', bitrate]
+    # Tag dal file di spotdl (il demuxer ogg sposta la copertina in uno stream
+    # video, che con -map 0:a non arriva nel file finale)
+    command += ['-map_metadata', '0', target]
+    return command
+
+def read_cover(path):
+    """Prima copertina nei tag di un file audio come mutagen.flac.Picture, o None."""
+    if mutagen is None:
+        return None
+    try:
+        audio = mutagen.File(path)
+    except Exception:
+        return None
+    if audio is None:
+        return None
+    # FLAC
+    if getattr(audio, 'pictures', None):
+        return audio.pictures[0]
+    tags = audio.tags
+    if not tags:
+        return None
+    picture = Picture()
+    picture.type = 3  # copertina anteriore
+    if hasattr(tags, 'getall'):
+        # ID3 (mp3)
+        frames = tags.getall('APIC')
+        if not frames:
+            return None
+        picture.data, picture.mime, picture.type = frames[0].data, frames[0].mime, frames[0].type
+        return picture
+    if 'covr' in tags:
+        # MP4 (m4a)
+        cover = tags['covr'][0]
+        picture.data = bytes(cover)
+        picture.mime = 'image/png' if cover.imageformat == MP4Cover.FORMAT_PNG else 'image/jpeg'
+        return picture
+    # Vorbis comment (opus, ogg)
+    for value in tags.get('metadata_block_picture', []):
+        try:
+            return Picture(base64.b64decode(value))
+        except Exception:
+            continue
+    return None
+
+def copy_cover(source, target):
+    """
+    Copia la copertina di `source` in `target` (opus/ogg) come
+    METADATA_BLOCK_PICTURE, se `target` non ne ha gia' una. Restituisce
+    True se `target` ha una copertina alla fine.
+    """
+    picture = read_cover(source)
+    if picture is None:
+        return False
+    audio = mutagen.File(target)
+    if audio is None:
+        return False
+    if audio.tags is None:
+        audio.add_tags()
+    if 'metadata_block_picture' not in audio.tags:
+        audio.tags['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+        audio.save()
+    return True
+
+def process_file(source, output_dir, audio_format=POSTPROCESS_FORMAT, bitrate=POSTPROCESS_BITRATE,
+                 loudnorm=POSTPROCESS_LOUDNORM, timeout=POSTPROCESS_TIMEOUT, keep_failed=True):
+    """
+    Converte un file scaricato nella cartella di output con un processo
+    ffmpeg: restituisce (percorso finale, errore o None). Se ffmpeg
+    fallisce il file originale viene spostato comunque nella libreria, per
+    non perdere un download riuscito (con keep_failed=False viene eliminato).
+    """
+    name = os.path.splitext(os.path.basename(source))[0]
+    target = os.path.join(output_dir, f"{name}.{audio_format}")
+    if os.path.exists(target):
+        os.remove(source)
+        return target, None
+    partial = os.path.join(os.path.dirname(source), f"{name}.part.{audio_format}")
+    try:
+        subprocess.run(build_ffmpeg_command(source, partial, audio_format, bitrate, loudnorm),
+                       check=True, capture_output=True, text=True, timeout=timeout)
+        if not _CODECS[audio_format][1]:
+            try:
+                copy_cover(source, partial)
+            except Exception as e:
+                # Il file convertito e' comunque valido: si perde solo la copertina
+                print(f"Copertina non copiata in {os.path.basename(target)}: {e}")
+        os.replace(partial, target)
+        os.remove(source)
+        return target, None
+    except (subprocess.SubprocessError, OSError) as e:
+        detail = getattr(e, 'stderr', None) or str(e)
+        if os.path.exists(partial):
+            os.remove(partial)
+        error = detail.strip().splitlines()[-1] if detail.strip() else str(e)
+        if not keep_failed:
+            os.remove(source)
+            return None, error
+        fallback = os.path.join(output_dir, os.path.basename(source))
+        shutil.move(source, fallback)
+        return fallback, error
+
+class PostProcessor:
+    """
+    Pool di processi ffmpeg (uno per core di default) per la parte
+    CPU-bound dei download. spotdl salva lo stream nativo in una cartella di
+    staging per job; a fine job i file vengono passati qui e convertiti,
+    normalizzati e spostati in `output_dir`, mentre i processi spotdl passano
+    al batch successivo.
+
+    Il lavoro lo fanno i processi ffmpeg: i thread del pool si limitano ad
+    aspettarli, quindi non serve un ProcessPoolExecutor (che con spawn
+    reimporterebbe app.py nei processi figli).
+
+    Finche' una cartella di staging e' in uso, il processo che l'ha creata
+    tiene un lock (flock) sul suo file OWNER_LOCK. All'avvio recover()
+    riprende le cartelle che nessun processo vivo possiede (app web o
+    discover terminati prima della post-elaborazione), anche se create
+    dall'altro container.
+    """
+    def __init__(self, output_dir, max_workers=POSTPROCESS_WORKERS, on_file=None):
+        self.output_dir = output_dir
+        # on_file(percorso) per ogni file arrivato nella libreria
+        self.on_file = on_file
+        self.staging_dir = os.path.join(output_dir, STAGING_DIRNAME)
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='postprocess')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+        # Cartella di staging -> file di lock aperto
+        self._owned = {}
+
+    def job_dir(self, job_id):
+        """Cartella di staging (nuova e univoca anche tra app web e discover) di un job di download."""
+        os.makedirs(self.staging_dir, exist_ok=True)
+        directory = tempfile.mkdtemp(prefix=f"job-{job_id}-", dir=self.staging_dir)
+        if fcntl:
+            lock = open(os.path.join(directory, OWNER_LOCK), 'w')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with self._lock:
+                self._owned[directory] = lock
+        return directory
+
+    def remove_dir(self, directory):
+        """Rilascia e rimuove una cartella di staging."""
+        with self._lock:
+            lock = self._owned.pop(directory, None)
+        shutil.rmtree(directory, ignore_errors=True)
+        if lock:
+            lock.close()
+
+    def recover(self):
+        """
+        Rimette in coda i file delle cartelle di staging abbandonate (nessun
+        processo ne tiene il lock). Restituisce il numero di cartelle riprese.
+        """
+        if not fcntl or not os.path.isdir(self.staging_dir):
+            return 0
+        recovered = 0
+        for name in os.listdir(self.staging_dir):
+            directory = os.path.join(self.staging_dir, name)
+            if not os.path.isdir(directory):
+                continue
+            try:
+                lock = open(os.path.join(directory, OWNER_LOCK), 'a')
+            except OSError:
+                continue
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Cartella ancora in uso da un processo vivo
+                lock.close()
+                continue
+            with self._lock:
+                self._owned[directory] = lock
+            # Uscite di ffmpeg interrotte a meta'
+            for leftover in os.listdir(directory):
+                if '.part.' in leftover:
+                    os.remove(os.path.join(directory, leftover))
+            # Non si sa se spotdl aveva finito: i file illeggibili vengono scartati
+            self.submit_dir(directory, keep_failed=False)
+            recovered += 1
+        if recovered:
+            print(f">>> Riprese {recovered} cartelle di staging rimaste da un'esecuzione precedente. <<<")
+        return recovered
+
+    def submit_dir(self, directory, keep_failed=True, on_output=None, on_complete=None):
+        """
+        Mette in coda i file audio di `directory`; la cartella viene rimossa
+        quando sono finiti. Con keep_failed=False (spotdl interrotto, i file
+        potrebbero essere troncati) un file che ffmpeg non riesce a leggere
+        viene scartato invece di finire nella libreria.
+
+        on_complete(scartati) viene chiamata quando tutti i file sono nella
+        libreria (o scartati), con il numero di file scartati.
+        """
+        files = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith(_AUDIO_EXTENSIONS)
+        )
+        if not files:
+            self.remove_dir(directory)
+            if on_complete:
+                on_complete(0)
+            return []
+        remaining = {'files': len(files), 'discarded': 0}
+        futures = []
+        for path in files:
+            with self._lock:
+                self._pending += 1
+            metrics.POSTPROCESS_PENDING.inc()
+            started = time.monotonic()
+            future = self._pool.submit(process_file, path, self.output_dir, keep_failed=keep_failed)
+            future.add_done_callback(
+                lambda future, path=path, started=started: self._done(future, path, started, directory, remaining,
+                                                                      on_output, on_complete)
+            )
+            futures.append(future)
+        return futures
+
+    def _done(self, future, path, started, directory, remaining, on_output, on_complete):
+        metrics.POSTPROCESS_PENDING.dec()
+        try:
+            target, error = future.result()
+        except Exception as e:
+            # Errore inatteso: il file resta in staging e va perso
+            target, error = None, str(e)
+        metrics.POSTPROCESS_FILES.inc(status='errore' if error else 'ok')
+        metrics.POSTPROCESS_SECONDS.observe(time.monotonic() - started)
+        name = os.path.basename(target or path)
+        if target and self.on_file:
+            try:
+                self.on_file(target)
+            except Exception as e:
+                print(f"Errore nel callback del file {name}: {e}")
+        if error:
+            kept = "file originale mantenuto" if target else "file scartato"
+            message = f"Post-elaborazione non riuscita per {name} ({kept}): {error}"
+            print(message)
+        else:
+            message = f"Post-elaborazione completata: {name}"
+        if on_output:
+            try:
+                on_output(message)
+            except Exception as e:
+                print(f"Errore nel callback della post-elaborazione: {e}")
+        with self._lock:
+            remaining['files'] -= 1
+            if target is None:
+                remaining['discarded'] += 1
+            finished = remaining['files'] == 0
+        if finished:
+            self.remove_dir(directory)
+            if on_complete:
+                try:
+                    on_complete(remaining['discarded'])
+                except Exception as e:
+                    print(f"Errore nel callback di fine post-elaborazione: {e}")
+        with self._lock:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def wait(self):
+        """Attende che tutti i file in coda siano elaborati."""
+        with self._idle:
+            while self._pending:
+                self._idle.wait()
+
+    def shutdown(self):
+        self.wait()
+        self._pool.shutdown(wait=True)
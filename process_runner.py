@@ -0,0 +1,166 @@
+import os
+import re
+import signal
+import time
+import selectors
+import subprocess
+import logging
+from logging.handlers import RotatingFileHandler
+
+# Caratteri massimi di una riga di output: le barre di avanzamento che si
+# aggiornano con '\r' senza mai andare a capo non accumulano memoria
+MAX_LINE_LENGTH = 4096
+# Ogni quanto il ciclo di lettura controlla timeout e annullamento anche senza output
+POLL_INTERVAL = 0.5
+_READ_SIZE = 65536
+_LINE_SPLIT_RE = re.compile(rb'[\r\n]')
+
+def kill_process_tree(process):
+    """
+    Termina il processo e i suoi figli (es. ffmpeg lanciato da spotdl),
+    che altrimenti terrebbero aperta la pipe di output.
+    """
+    if process.poll() is not None:
+        return
+    try:
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+class StreamingProcess:
+    """
+    Esegue un comando leggendo l'output man mano, senza bloccarsi su di esso.
+
+    stdout e stderr vengono letti in modo non bloccante con un selector:
+    il timeout e' un vero limite di tempo dall'avvio, controllato anche
+    quando il processo resta bloccato senza scrivere niente o tiene aperta la
+    pipe dopo l'ultima riga. Ogni riga completa (terminata da '\\n' o '\\r')
+    viene passata subito a `on_line` e poi scartata: la memoria usata non
+    dipende dalla durata del processo ne' dalla quantita' di output.
+    """
+    def __init__(self, command, timeout=None, on_line=None, max_line=MAX_LINE_LENGTH):
+        self.command = command
+        self.timeout = timeout
+        self.on_line = on_line
+        self.max_line = max_line
+        self.process = None
+        self.returncode = None
+        self.timed_out = False
+        self._pending = b''
+        self._truncating = False
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+            start_new_session=(os.name == 'posix'),
+        )
+        self._started = time.monotonic()
+        return self.process
+
+    def kill(self):
+        if self.process:
+            kill_process_tree(self.process)
+
+    def _remaining(self):
+        if self.timeout is None:
+            return None
+        return self._started + self.timeout - time.monotonic()
+
+    def run(self):
+        """Avvia il processo (se non e' gia' partito), legge tutto l'output e restituisce il codice di uscita."""
+        if self.process is None:
+            self.start()
+        stdout = self.process.stdout
+        os.set_blocking(stdout.fileno(), False)
+        selector = selectors.DefaultSelector()
+        selector.register(stdout, selectors.EVENT_READ)
+        try:
+            while True:
+                remaining = self._remaining()
+                if remaining is not None and remaining <= 0:
+                    self._expire()
+                    break
+                wait = POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining)
+                if not selector.select(wait):
+                    if self.process.poll() is not None:
+                        # Processo terminato ma pipe tenuta aperta da un figlio rimasto in vita
+                        self._kill_leftovers()
+                        break
+                    continue
+                try:
+                    chunk = os.read(stdout.fileno(), _READ_SIZE)
+                except BlockingIOError:
+                    continue
+                if not chunk:
+                    break
+                self._feed(chunk)
+        finally:
+            selector.close()
+            stdout.close()
+        if self._pending and not self._truncating:
+            self._emit(self._pending)
+            self._pending = b''
+
+        # Pipe chiusa ma processo ancora vivo: aspetta al massimo il tempo rimasto
+        remaining = self._remaining()
+        try:
+            self.process.wait(timeout=None if remaining is None else max(0, remaining))
+        except subprocess.TimeoutExpired:
+            self._expire()
+            self.process.wait()
+        self.returncode = self.process.returncode
+        return self.returncode
+
+    def _kill_leftovers(self):
+        if os.name == 'posix':
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+    def _expire(self):
+        self.timed_out = True
+        self.kill()
+
+    def _feed(self, chunk):
+        parts = _LINE_SPLIT_RE.split(self._pending + chunk)
+        self._pending = parts.pop()
+        if parts and self._truncating:
+            # Fine della riga troppo lunga gia' passata a on_line
+            parts.pop(0)
+            self._truncating = False
+        for part in parts:
+            self._emit(part)
+        if len(self._pending) > self.max_line:
+            # Riga troppo lunga: si passa l'inizio e si scarta il resto fino all'a capo
+            if not self._truncating:
+                self._emit(self._pending)
+            self._truncating = True
+            self._pending = b''
+
+    def _emit(self, raw):
+        line = raw[:self.max_line].decode('utf-8', errors='replace').strip()
+        if line and self.on_line:
+            self.on_line(line)
+
+def rotating_log(path, max_bytes, backups=3, name='spotdl'):
+    """
+    Logger che scrive l'output completo in `path`, ruotando il file oltre
+    `max_bytes` (tiene `backups` file precedenti). None se `path` e' vuoto.
+    """
+    if not path:
+        return None
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    logger = logging.getLogger(f"{name}.output")
+    if not logger.handlers:
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
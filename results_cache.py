@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from http_cache import DATA_DIR
+
+RESULTS_CACHE_PATH = os.getenv("RESULTS_CACHE_PATH", os.path.join(DATA_DIR, "results_cache.db"))
+RESULTS_CACHE_MAX_ARTISTS = int(os.getenv("RESULTS_CACHE_MAX_ARTISTS", "500"))
+RESULTS_CACHE_TTL = int(os.getenv("RESULTS_CACHE_TTL", str(24 * 3600)))
+
+class ResultsCache:
+    """
+    Cache dei risultati di ricerca (artista -> album) condivisa tra i worker.
+
+    Sostituisce il dizionario in memoria di app.py: vive in un file SQLite,
+    quindi /download trova gli album anche se gira in un processo diverso da
+    /search. Gli album sono indicizzati per (artista, album) e la ricerca per
+    id e' una lookup sulla chiave primaria. Le ricerche piu' vecchie di `ttl`
+    e quelle oltre `max_artists` (le meno usate) vengono eliminate.
+
+    Insieme agli album vengono salvate le loro tracklist, precaricate in
+    background dopo la ricerca: aprire le tracce di un album o scaricarlo non
+    richiede altre chiamate all'API.
+    """
+    def __init__(self, path=RESULTS_CACHE_PATH, max_artists=RESULTS_CACHE_MAX_ARTISTS, ttl=RESULTS_CACHE_TTL):
+        self.path = path
+        self.max_artists = max_artists
+        self.ttl = ttl
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS artists (
+                    artist_id TEXT PRIMARY KEY,
+                    artist_name TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS albums (
+                    artist_id TEXT NOT NULL REFERENCES artists(artist_id) ON DELETE CASCADE,
+                    album_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    url TEXT,
+                    image_url TEXT,
+                    PRIMARY KEY (artist_id, album_id)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS album_tracks (
+                    artist_id TEXT NOT NULL REFERENCES artists(artist_id) ON DELETE CASCADE,
+                    album_id TEXT NOT NULL,
+                    tracks TEXT NOT NULL,
+                    PRIMARY KEY (artist_id, album_id)
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS artists_last_access ON artists (last_access)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def put(self, artist_id, artist_name, albums):
+        """Salva (o sostituisce) i risultati della ricerca di un artista."""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM artists WHERE artist_id = ?", (artist_id,))
+            conn.execute(
+                "INSERT INTO artists (artist_id, artist_name, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (artist_id, artist_name, now, now),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO albums (artist_id, album_id, position, name, url, image_url) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (artist_id, album['id'], i, album['name'], album.get('url'), album.get('image_url'))
+                    for i, album in enumerate(albums)
+                ],
+            )
+        self._evict()
+
+    def get(self, artist_id):
+        """Restituisce {'artist_name', 'albums'} o None se assente o scaduto."""
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT artist_name FROM artists WHERE artist_id = ? AND created_at > ?",
+            (artist_id, time.time() - self.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+        albums = [
+            dict(album) for album in conn.execute(
+                "SELECT album_id AS id, name, url, image_url FROM albums WHERE artist_id = ? ORDER BY position",
+                (artist_id,),
+            )
+        ]
+        self._touch(artist_id)
+        return {'artist_name': row['artist_name'], 'albums': albums}
+
+    def get_album(self, artist_id, album_id):
+        """Restituisce un album dei risultati di `artist_id` in tempo costante, o None."""
+        conn = self._connection()
+        row = conn.execute(
+            """SELECT albums.album_id AS id, albums.name, albums.url, albums.image_url
+               FROM albums JOIN artists USING (artist_id)
+               WHERE albums.artist_id = ? AND albums.album_id = ? AND artists.created_at > ?""",
+            (artist_id, album_id, time.time() - self.ttl),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def _touch(self, artist_id):
+        conn = self._connection()
+        with conn:
+            conn.execute("UPDATE artists SET last_access = ? WHERE artist_id = ?", (time.time(), artist_id))
+
+    def _evict(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM artists WHERE created_at <= ?", (time.time() - self.ttl,))
+            conn.execute(
+                """DELETE FROM artists WHERE artist_id IN (
+                       SELECT artist_id FROM artists ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                   )""",
+                (self.max_artists,),
+            )
+
+    def put_tracks(self, artist_id, tracklists):
+        """
+        Salva le tracklist ({album_id: tracce}) degli album di `artist_id`.
+        Delle tracce si tengono solo i campi usati da app.py.
+        """
+        conn = self._connection()
+        with conn:
+            if not conn.execute("SELECT 1 FROM artists WHERE artist_id = ?", (artist_id,)).fetchone():
+                # Ricerca gia' eliminata (o sostituita): niente da associare
+                return
+            conn.executemany(
+                "INSERT OR REPLACE INTO album_tracks (artist_id, album_id, tracks) VALUES (?, ?, ?)",
+                [
+                    (artist_id, album_id, json.dumps([_compact_track(track) for track in tracks]))
+                    for album_id, tracks in tracklists.items()
+                ],
+            )
+
+    def get_tracks(self, artist_id, album_ids):
+        """Tracklist in cache degli album indicati, come {album_id: tracce}; gli assenti mancano."""
+        album_ids = list(album_ids)
+        if not album_ids:
+            return {}
+        placeholders = ','.join('?' * len(album_ids))
+        rows = self._connection().execute(
+            f"""SELECT album_tracks.album_id, album_tracks.tracks
+                FROM album_tracks JOIN artists USING (artist_id)
+                WHERE album_tracks.artist_id = ? AND album_tracks.album_id IN ({placeholders})
+                  AND artists.created_at > ?""",
+            [artist_id, *album_ids, time.time() - self.ttl],
+        )
+        return {album_id: json.loads(tracks) for album_id, tracks in rows}
+
+def _compact_track(track):
+    return {
+        'id': track.get('id'),
+        'name': track.get('name'),
+        'duration_ms': track.get('duration_ms'),
+        'artists': [{'id': artist.get('id'), 'name': artist.get('name')} for artist in track.get('artists') or []],
+        'external_urls': {'spotify': track.get('external_urls', {}).get('spotify')},
+    }
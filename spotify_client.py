@@ -1,145 +1,450 @@
 import requests
-import base64
+from requests.adapters import HTTPAdapter
 import json
 import time
 import os
+import random
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from http_cache import HTTPCache, CACHE_PATH, cache_key, ttl_for_url
+from token_manager import TokenManager
+from dedup import dedup_releases
+import metrics
+
+# Endpoint di Spotify (sovrascrivibili per puntare a uno stub locale)
+API_BASE_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+
+# Dimensioni del pool di connessioni HTTP keep-alive
+POOL_CONNECTIONS = int(os.getenv("SPOTIFY_POOL_CONNECTIONS", "4"))
+POOL_MAXSIZE = int(os.getenv("SPOTIFY_POOL_MAXSIZE", "16"))
+
+# Budget di richieste verso l'API (richieste/secondo e burst massimo)
+RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))
+RATE_BURST = int(os.getenv("SPOTIFY_RATE_BURST", "10"))
+MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "5"))
+
+# Pagine di uno stesso elenco richieste in parallelo dopo la prima
+PAGE_WORKERS = int(os.getenv("SPOTIFY_PAGE_WORKERS", "4"))
+
+# ID massimi per chiamata degli endpoint "multipli" dell'API
+MAX_ALBUMS_PER_REQUEST = 20
+MAX_ARTISTS_PER_REQUEST = 50
+MAX_TRACKS_PER_REQUEST = 50
+
+# Elementi massimi raggiungibili con la paginazione di /search
+MAX_SEARCH_RESULTS = 1000
+
+# RateLimiter attivi nel processo: il gauge riporta il rate del piu' restrittivo
+# (di norma ce n'e' uno solo, condiviso da tutti i client)
+_rate_limiters = weakref.WeakSet()
+
+def _current_rate():
+    rates = [limiter.rate for limiter in list(_rate_limiters)]
+    return min(rates) if rates else RATE_LIMIT
+
+metrics.RATE_LIMIT.set_function(_current_rate)
+
+class RateLimiter:
+    """
+    Token bucket adattivo condiviso da tutte le richieste di un client.
+
+    Il rate parte da `rate` e viene adattato in stile AIMD: dimezzato a ogni
+    429 e rialzato gradualmente dopo le risposte andate a buon fine, senza mai
+    superare il massimo configurato. Un Retry-After sospende tutte le richieste
+    fino alla scadenza indicata dal server.
+    """
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, min_rate=0.5):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+        _rate_limiters.add(self)
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """Blocca finche' non e' disponibile un token."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self, headers=None):
+        """Aumenta il rate dopo una risposta valida e legge gli header di quota."""
+        with self._lock:
+            remaining, reset = _parse_rate_headers(headers or {})
+            if remaining is not None and reset:
+                # Il server dichiara la quota residua: la distribuiamo sul tempo rimasto
+                self.rate = max(self.min_rate, min(self.max_rate, remaining / reset))
+            else:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def on_throttle(self, retry_after=None):
+        """Gestisce un 429: dimezza il rate e sospende fino al Retry-After."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+def _parse_rate_headers(headers):
+    """Estrae (richieste residue, secondi al reset) dagli header X-RateLimit-*, se presenti."""
+    try:
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return None, None
+        return float(remaining), max(1.0, float(reset))
+    except (TypeError, ValueError):
+        return None, None
+
+def _parse_retry_after(value):
+    """Converte l'header Retry-After (in secondi) in float."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+def _chunks(items, size):
+    """Divide una lista in blocchi di al massimo `size` elementi."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _backoff_delay(attempt, base=0.5, cap=30.0):
+    """Backoff esponenziale con full jitter."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def _released_before(release_date, since_date):
+    """
+    True se `release_date` e' anteriore a `since_date`. Le date di Spotify
+    possono avere la sola precisione di anno o mese ('2024', '2024-03'): si
+    confronta solo la parte comune, cosi' una release del 2024 non risulta
+    piu' vecchia del 2024-03-01.
+    """
+    length = min(len(release_date), len(since_date))
+    return release_date[:length] < since_date[:length]
 
 class SpotifyClient:
     """
     Un client per l'API di Spotify che gestisce automaticamente
-    l'autenticazione e il rinnovo del token.
+    l'autenticazione e il rinnovo del token (vedi TokenManager).
+
+    Le richieste passano da un pool di connessioni keep-alive condiviso:
+    ogni thread usa una propria requests.Session (i cookie e lo stato della
+    sessione non sono thread-safe), ma tutte montano lo stesso HTTPAdapter,
+    il cui pool urllib3 e' thread-safe e limita le connessioni per host.
     """
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, pool_connections=None, pool_maxsize=None, rate_limiter=None, cache=None):
         self.client_id = client_id
         self.client_secret = client_secret
-        self.access_token = None
-        self.token_expiration_time = 0
-
-    def _get_new_token(self):
-        """Ottiene un nuovo token di accesso da Spotify."""
-        auth_url = 'https://accounts.spotify.com/api/token'
-        auth_header = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode('utf-8')).decode('utf-8')
-        headers = {'Authorization': f'Basic {auth_header}'}
-        data = {'grant_type': 'client_credentials'}
-        
-        try:
-            response = requests.post(auth_url, headers=headers, data=data, timeout=10)
-            response.raise_for_status()
-            token_info = response.json()
-            self.access_token = token_info.get('access_token')
-            self.token_expiration_time = time.time() + 3500 
-            print(">>> Token Spotify rinnovato con successo. <<<")
-            return True
-        except requests.exceptions.RequestException as e:
-            print(f"ERRORE CRITICO: Impossibile ottenere il token da Spotify: {e}")
-            self.access_token = None
-            return False
-
-    def _ensure_token(self):
-        """Assicura di avere un token valido, altrimenti ne richiede uno nuovo."""
-        if not self.access_token or time.time() > self.token_expiration_time:
-            return self._get_new_token()
-        return True
-
-    def _make_request(self, url, params=None, headers=None):
-        """Esegue una richiesta GET all'API di Spotify, gestendo il token."""
-        if not self._ensure_token():
-            return None
-
-        request_headers = {'Authorization': f'Bearer {self.access_token}'}
-        if headers:
-            request_headers.update(headers)
-
-        try:
-            response = requests.get(url, headers=request_headers, params=params, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            if e.response and e.response.status_code == 401:
-                print(">>> Errore 401 rilevato. Forzo il rinnovo del token. <<<")
-                self.access_token = None
-            else:
-                 print(f"Errore durante la richiesta API a {url}: {e}")
-            return None
+        # pool_connections: numero di host distinti tenuti in cache;
+        # pool_maxsize: connessioni massime verso lo stesso host.
+        # Con pool_block i thread in eccesso attendono una connessione libera
+        # invece di aprirne di nuove che verrebbero poi scartate.
+        self._adapter = HTTPAdapter(
+            pool_connections=pool_connections or POOL_CONNECTIONS,
+            pool_maxsize=pool_maxsize or POOL_MAXSIZE,
+            pool_block=True,
+        )
+        self._local = threading.local()
+        # Un solo rinnovo del token alla volta, condiviso con gli altri processi
+        self.tokens = TokenManager(client_id, client_secret, session=lambda: self.session)
+        # Tutte le richieste del client passano dallo stesso token bucket
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # Cache persistente delle risposte (cache=False la disabilita)
+        if cache is None and CACHE_PATH:
+            cache = HTTPCache()
+        self.cache = cache or None
+        # Thread per le pagine successive alla prima (creati solo se servono)
+        self._pages = ThreadPoolExecutor(max_workers=PAGE_WORKERS, thread_name_prefix='spotify-pages')
+
+    @property
+    def session(self):
+        """Restituisce la sessione HTTP del thread corrente, creandola se serve."""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            self._local.session = session
+        return session
+
+    def close(self):
+        """Chiude tutte le connessioni del pool."""
+        self.tokens.close()
+        self._pages.shutdown(wait=False)
+        self._adapter.close()
+
+    def _make_request(self, url, params=None, headers=None, revalidate=False):
+        """
+        Esegue una richiesta GET all'API di Spotify, gestendo il token,
+        il rate limiting (429/Retry-After) e i tentativi con backoff.
+        Le risposte passano dalla cache persistente, se abilitata; con
+        `revalidate` una voce ancora valida viene comunque verificata con il
+        server (con l'ETag, se c'e').
+        """
+        endpoint = metrics.endpoint_name(url)
+        key = cache_key(url, params)
+        cached = self.cache.get(key) if self.cache else None
+        if cached and cached[2] and not revalidate:
+            metrics.API_REQUESTS.inc(endpoint=endpoint, status='cache')
+            return cached[0]
+
+        reauthenticated = False
+        for attempt in range(MAX_RETRIES + 1):
+            token = self.tokens.get()
+            if not token:
+                return None
+
+            request_headers = {'Authorization': f'Bearer {token}'}
+            if cached and cached[1]:
+                # Voce scaduta con ETag: chiediamo al server se e' cambiata
+                request_headers['If-None-Match'] = cached[1]
+            if headers:
+                request_headers.update(headers)
+
+            self.rate_limiter.acquire()
+            try:
+                with metrics.API_LATENCY.time(endpoint=endpoint):
+                    response = self.session.get(url, headers=request_headers, params=params, timeout=10)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.API_REQUESTS.inc(endpoint=endpoint, status='rete')
+                metrics.API_RETRIES.inc(endpoint=endpoint, reason='rete')
+                print(f"Errore di rete verso {url} (tentativo {attempt + 1}): {e}")
+                time.sleep(_backoff_delay(attempt))
+                continue
+            except requests.exceptions.RequestException as e:
+                metrics.API_REQUESTS.inc(endpoint=endpoint, status='errore')
+                print(f"Errore durante la richiesta API a {url}: {e}")
+                return None
+
+            metrics.API_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+            if response.status_code == 429:
+                metrics.API_RETRIES.inc(endpoint=endpoint, reason='429')
+                retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+                print(f">>> Rate limit raggiunto (429). Attendo {retry_after or 'backoff'}s. <<<")
+                self.rate_limiter.on_throttle(retry_after)
+                if retry_after is None:
+                    time.sleep(_backoff_delay(attempt))
+                continue
+            if response.status_code >= 500:
+                metrics.API_RETRIES.inc(endpoint=endpoint, reason='5xx')
+                print(f"Errore {response.status_code} dal server per {url} (tentativo {attempt + 1}).")
+                time.sleep(_backoff_delay(attempt))
+                continue
+            if response.status_code == 401:
+                if reauthenticated:
+                    print(f"Errore 401 per {url} anche con un token nuovo.")
+                    return None
+                # Token scaduto o revocato: la richiesta riparte con uno nuovo
+                print(">>> Errore 401 rilevato. Rinnovo il token e ripeto la richiesta. <<<")
+                metrics.API_RETRIES.inc(endpoint=endpoint, reason='401')
+                self.tokens.invalidate(token)
+                reauthenticated = True
+                continue
+            if response.status_code == 304 and cached:
+                self.cache.refresh(key, ttl_for_url(url))
+                self.rate_limiter.on_success(response.headers)
+                return cached[0]
+
+            try:
+                response.raise_for_status()
+                data = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Errore durante la richiesta API a {url}: {e}")
+                return None
+            self.rate_limiter.on_success(response.headers)
+            if self.cache:
+                self.cache.set(key, data, response.headers.get('ETag'), ttl_for_url(url))
+            return data
+
+        print(f"Richiesta API a {url} fallita dopo {MAX_RETRIES + 1} tentativi.")
+        return None
 
     def search_artist(self, artist_name):
         """Cerca un artista per nome."""
-        search_url = 'https://api.spotify.com/v1/search'
+        search_url = f'{API_BASE_URL}/search'
         params = {'q': artist_name, 'type': 'artist', 'market': 'IT', 'limit': 1}
         data = self._make_request(search_url, params=params)
         if data and data.get('artists', {}).get('items'):
             return data['artists']['items'][0]
         return None
 
+    def _get_all_pages(self, url, params, key=None, max_items=None):
+        """
+        Recupera tutti gli elementi di un endpoint paginato con limit/offset.
+        La prima pagina dice quanti elementi ci sono (`total`): le altre
+        vengono richieste in parallelo invece di seguire `next` una alla volta.
+        Una pagina non riuscita viene saltata.
+
+        `key` indica dove si trova la pagina nella risposta (per /search,
+        per esempio 'artists'); `max_items` limita gli elementi richiesti.
+        """
+        def get_page(offset=None):
+            data = self._make_request(url, params=params if offset is None else dict(params, offset=offset))
+            return (data or {}).get(key) if key else data
+
+        first = get_page()
+        if not first:
+            return []
+        items = list(first.get('items', []))
+        limit = first.get('limit') or params.get('limit') or 20
+        total = first.get('total') or 0
+        if max_items is not None:
+            total = min(total, max_items)
+        offsets = range(first.get('offset', 0) + limit, total, limit)
+        if not first.get('next') or not offsets:
+            return items[:max_items]
+        for page in self._pages.map(get_page, offsets):
+            if page:
+                items.extend(page.get('items', []))
+        return items[:max_items]
+
     def get_artist_albums(self, artist_id):
-        """Recupera solo gli album e i singoli di un artista."""
-        albums = []
-        url = f'https://api.spotify.com/v1/artists/{artist_id}/albums'
+        """Recupera solo gli album e i singoli di un artista, una sola edizione per release."""
+        url = f'{API_BASE_URL}/artists/{artist_id}/albums'
         params = {'include_groups': 'album,single', 'market': 'IT', 'limit': 50}
-        processed_album_names = set()
-        while url:
-            page = self._make_request(url, params=params)
-            if not page:
-                break
-            for item in page.get('items', []):
-                if item['name'].lower() not in processed_album_names:
-                    albums.append(item)
-                    processed_album_names.add(item['name'].lower())
-            url = page.get('next')
-            params = {}
-        return albums
+        return dedup_releases(self._get_all_pages(url, params))
+
+    def get_new_artist_albums(self, artist_id, known_album_ids, since_date=None):
+        """
+        Recupera solo le release di un artista non ancora note.
+
+        Ogni gruppo (album, singoli) e' restituito dall'API dal piu' recente:
+        la paginazione si ferma alla prima release gia' nota o piu' vecchia
+        di `since_date`, quindi per un artista aggiornato basta una chiamata
+        per gruppo.
+        """
+        new_albums = []
+        known_album_ids = set(known_album_ids)
+        for group in ('album', 'single'):
+            url = f'{API_BASE_URL}/artists/{artist_id}/albums'
+            params = {'include_groups': group, 'market': 'IT', 'limit': 20}
+            while url:
+                # Le release nuove vanno viste subito, non allo scadere della cache (TTL di un giorno)
+                page = self._make_request(url, params=params, revalidate=True)
+                if not page:
+                    break
+                reached_known = False
+                for item in page.get('items', []):
+                    if item['id'] in known_album_ids or (since_date and _released_before(item.get('release_date', ''), since_date)):
+                        reached_known = True
+                        break
+                    new_albums.append(item)
+                if reached_known:
+                    break
+                url = page.get('next')
+                params = {}
+        return dedup_releases(new_albums)
 
     def get_album_tracks(self, album_id):
         """Recupera tutte le tracce di un album."""
-        tracks = []
-        url = f'https://api.spotify.com/v1/albums/{album_id}/tracks'
-        params = {'market': 'IT', 'limit': 50, 'fields': 'items(name,popularity,id,external_urls.spotify),next'}
-        while url:
-            page = self._make_request(url, params=params)
-            if not page:
-                break
-            tracks.extend(page.get('items', []))
-            url = page.get('next')
-            params = {}
-        return tracks
+        url = f'{API_BASE_URL}/albums/{album_id}/tracks'
+        return self._get_all_pages(url, {'market': 'IT', 'limit': 50})
     
     def get_related_artists(self, artist_id):
-        """Ottiene gli artisti correlati da Spotify."""
-        url = f'https://api.spotify.com/v1/artists/{artist_id}/related-artists'
+        """
+        Ottiene gli artisti correlati da Spotify; None se la richiesta fallisce
+        (diverso da una lista vuota, per non considerare espanso l'artista).
+        """
+        url = f'{API_BASE_URL}/artists/{artist_id}/related-artists'
         data = self._make_request(url)
-        return data.get('artists', []) if data else []
+        return data.get('artists', []) if data is not None else None
 
     def get_playlist_track_artists(self, playlist_id):
-        """Recupera gli artisti principali delle tracce di una playlist."""
-        url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
-        params = {'fields': 'items(track(artists(id,name,popularity)))', 'limit': 50}
-        data = self._make_request(url, params=params)
-        if not data:
+        """
+        Recupera gli artisti principali delle tracce di una playlist, tutte le
+        pagine. Gli artisti delle tracce sono in forma ridotta (id e nome,
+        senza popolarita'): per filtrarli serve get_artists_bulk.
+        """
+        url = f"{API_BASE_URL}/playlists/{playlist_id}/tracks"
+        params = {'fields': 'items(track(artists(id,name))),limit,offset,total,next', 'limit': 100}
+        items = self._get_all_pages(url, params)
+        if not items:
             print(f"  -> ATTENZIONE: La playlist con ID '{playlist_id}' non è stata trovata o è vuota. Salto.")
             return []
         artists = []
-        for item in data.get('items', []):
+        for item in items:
             track = item.get('track')
             if track and track.get('artists'):
                 artists.append(track['artists'][0])
         return artists
 
-    def search_for_genre(self, genre):
-        """Cerca artisti per un dato genere."""
-        url = 'https://api.spotify.com/v1/search'
-        params = {'q': f'genre:"{genre}"', 'type': 'artist', 'limit': 20}
-        data = self._make_request(url, params=params)
-        return data.get('artists', {}).get('items', []) if data else []
+    def search_for_genre(self, genre, max_results=MAX_SEARCH_RESULTS):
+        """Cerca artisti per un dato genere, fino a `max_results` risultati (50 per pagina)."""
+        url = f'{API_BASE_URL}/search'
+        params = {'q': f'genre:"{genre}"', 'type': 'artist', 'limit': 50}
+        return self._get_all_pages(url, params, key='artists', max_items=min(max_results, MAX_SEARCH_RESULTS))
 
     def get_tracks_by_ids(self, track_ids):
-        """Recupera i dettagli di più tracce in una sola chiamata."""
-        url = f"https://api.spotify.com/v1/tracks?ids={','.join(track_ids)}"
-        data = self._make_request(url)
-        return data.get('tracks', []) if data else []
+        """
+        Recupera i dettagli di più tracce, 50 per chiamata. Senza `market`:
+        con il market Spotify puo' sostituire una traccia con un'altra
+        equivalente (relinking), e l'`id` restituito non sarebbe quello
+        chiesto, usato per l'indice della libreria e la deduplicazione.
+        """
+        url = f"{API_BASE_URL}/tracks"
+        tracks = []
+        for chunk in _chunks(list(track_ids), MAX_TRACKS_PER_REQUEST):
+            data = self._make_request(url, params={'ids': ','.join(chunk)})
+            if data:
+                tracks.extend(data.get('tracks', []))
+        return tracks
+
+    def get_albums_bulk(self, album_ids):
+        """
+        Recupera album completi (tracklist inclusa), 20 per chiamata.
+        Le tracklist oltre le 50 tracce vengono completate seguendo `next`.
+        """
+        url = f"{API_BASE_URL}/albums"
+        albums = []
+        for chunk in _chunks(list(album_ids), MAX_ALBUMS_PER_REQUEST):
+            data = self._make_request(url, params={'ids': ','.join(chunk), 'market': 'IT'})
+            if not data:
+                continue
+            for album in data.get('albums', []):
+                if not album:
+                    continue
+                tracks = album.get('tracks') or {}
+                next_url = tracks.get('next')
+                while next_url:
+                    page = self._make_request(next_url)
+                    if not page:
+                        break
+                    tracks.setdefault('items', []).extend(page.get('items', []))
+                    next_url = page.get('next')
+                albums.append(album)
+        return albums
+
+    def get_artists_bulk(self, artist_ids):
+        """Recupera i dettagli completi (popolarita' inclusa) di piu' artisti, 50 per chiamata."""
+        url = f"{API_BASE_URL}/artists"
+        artists = []
+        for chunk in _chunks(list(artist_ids), MAX_ARTISTS_PER_REQUEST):
+            data = self._make_request(url, params={'ids': ','.join(chunk)})
+            if data:
+                artists.extend(artist for artist in data.get('artists', []) if artist)
+        return artists
 
     def search_playlist(self, playlist_name):
         """Cerca una playlist per nome."""
-        search_url = 'https://api.spotify.com/v1/search'
+        search_url = f'{API_BASE_URL}/search'
         params = {'q': playlist_name, 'type': 'playlist', 'market': 'IT', 'limit': 1}
         data = self._make_request(search_url, params=params)
         return data.get('playlists', {}).get('items', []) if data else []
@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from http_cache import DATA_DIR
+
+STATE_STORE_PATH = os.getenv("STATE_STORE_PATH", os.path.join(DATA_DIR, "discovery_state.db"))
+
+# File di testo usati prima del database, importati una sola volta
+LEGACY_SEED_FILE = 'seed_artists.txt'
+LEGACY_PROCESSED_FILE = 'processed_artists.txt'
+
+class StateStore:
+    """
+    Stato della scoperta (artisti seme e artisti processati) su SQLite.
+
+    Ogni aggiornamento e' una transazione atomica sulla singola riga, quindi
+    un crash non corrompe lo stato e segnare un artista costa O(log n) invece
+    di riscrivere tutto il file. Il database e' in modalita' WAL: l'app web
+    (che aggiunge seed) e il container discover possono usarlo insieme.
+    """
+    def __init__(self, path=STATE_STORE_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS seeds (artist_id TEXT PRIMARY KEY, added_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS processed (artist_id TEXT PRIMARY KEY, processed_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # Release note per artista: fanno da "watermark" per l'aggiornamento incrementale
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS releases (
+                    artist_id TEXT NOT NULL,
+                    album_id TEXT NOT NULL,
+                    release_date TEXT,
+                    PRIMARY KEY (artist_id, album_id)
+                )"""
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS refreshed (artist_id TEXT PRIMARY KEY, refreshed_at REAL NOT NULL)")
+            # Artisti accettati dalla pipeline ma non ancora completati, ripresi al riavvio
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pending_artists (artist_id TEXT PRIMARY KEY, releases TEXT, added_at REAL NOT NULL)"
+            )
+            # Tracce non riuscite da riprovare, con backoff
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS retries (
+                    url TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    artist_id TEXT,
+                    attempts INTEGER NOT NULL,
+                    next_attempt_at REAL NOT NULL,
+                    last_status TEXT
+                )"""
+            )
+            # Nodi del crawl degli artisti correlati: quelli con expanded = 0 sono la frontiera
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS crawl_nodes (
+                    artist_id TEXT PRIMARY KEY,
+                    hop INTEGER NOT NULL,
+                    popularity INTEGER NOT NULL,
+                    connections INTEGER NOT NULL,
+                    expanded INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+        self._import_legacy_files()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _import_legacy_files(self):
+        """Importa seed_artists.txt e processed_artists.txt al primo avvio."""
+        conn = self._connection()
+        with conn:
+            # App web e discover possono partire insieme su un database nuovo:
+            # il lock in scrittura rende controllo e import un'unica operazione
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+                return
+            now = time.time()
+            for filename, table in ((LEGACY_SEED_FILE, 'seeds'), (LEGACY_PROCESSED_FILE, 'processed')):
+                if not os.path.isfile(filename):
+                    continue
+                with open(filename, 'r') as f:
+                    ids = [(line.strip(), now) for line in f if line.strip()]
+                conn.executemany(f"INSERT OR IGNORE INTO {table} VALUES (?, ?)", ids)
+                if ids:
+                    print(f">>> Importati {len(ids)} artisti da '{filename}'. <<<")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('legacy_imported', ?)", (str(now),))
+
+    def add_seed(self, artist_id):
+        """Aggiunge un artista seme (ignorato se gia' presente)."""
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO seeds (artist_id, added_at) VALUES (?, ?)", (artist_id, time.time()))
+
+    def pending_seeds(self):
+        """Artisti seme non ancora processati."""
+        conn = self._connection()
+        rows = conn.execute(
+            "SELECT artist_id FROM seeds WHERE artist_id NOT IN (SELECT artist_id FROM processed) ORDER BY added_at"
+        )
+        return [row[0] for row in rows]
+
+    def remove_seeds(self, artist_ids):
+        conn = self._connection()
+        with conn:
+            conn.executemany("DELETE FROM seeds WHERE artist_id = ?", [(artist_id,) for artist_id in artist_ids])
+
+    def mark_processed(self, artist_ids):
+        """Segna gli artisti come processati (append, una transazione)."""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO processed (artist_id, processed_at) VALUES (?, ?)",
+                [(artist_id, now) for artist_id in artist_ids],
+            )
+
+    def is_processed(self, artist_id):
+        conn = self._connection()
+        return conn.execute("SELECT 1 FROM processed WHERE artist_id = ?", (artist_id,)).fetchone() is not None
+
+    def is_known(self, artist_id):
+        """True se l'artista e' gia' processato o in attesa come seme."""
+        conn = self._connection()
+        return conn.execute(
+            "SELECT 1 FROM processed WHERE artist_id = ? UNION ALL SELECT 1 FROM seeds WHERE artist_id = ? LIMIT 1",
+            (artist_id, artist_id),
+        ).fetchone() is not None
+
+    def processed_count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM processed").fetchone()[0]
+
+    def record_releases(self, artist_id, releases):
+        """Registra le release di un artista come note e aggiorna l'ora dell'ultimo controllo."""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO releases (artist_id, album_id, release_date) VALUES (?, ?, ?)",
+                [(artist_id, release['id'], release.get('release_date')) for release in releases],
+            )
+            conn.execute("INSERT OR REPLACE INTO refreshed (artist_id, refreshed_at) VALUES (?, ?)", (artist_id, now))
+
+    def release_watermark(self, artist_id):
+        """Restituisce (ID delle release note, data dell'ultima release) di un artista."""
+        conn = self._connection()
+        rows = conn.execute("SELECT album_id, release_date FROM releases WHERE artist_id = ?", (artist_id,)).fetchall()
+        dates = [date for _, date in rows if date]
+        return {album_id for album_id, _ in rows}, max(dates) if dates else None
+
+    def artists_to_refresh(self, older_than, limit=None):
+        """Artisti processati il cui ultimo controllo delle release e' precedente a `older_than` (timestamp)."""
+        conn = self._connection()
+        query = """SELECT processed.artist_id FROM processed
+                   LEFT JOIN refreshed USING (artist_id)
+                   WHERE refreshed.refreshed_at IS NULL OR refreshed.refreshed_at < ?
+                   ORDER BY COALESCE(refreshed.refreshed_at, 0)"""
+        params = [older_than]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [row[0] for row in conn.execute(query, params)]
+
+    def load_crawl(self):
+        """Nodi del crawl salvati, come (artist_id, hop, popolarita', collegamenti, espanso)."""
+        conn = self._connection()
+        return [
+            (artist_id, hop, popularity, connections, bool(expanded))
+            for artist_id, hop, popularity, connections, expanded in conn.execute(
+                "SELECT artist_id, hop, popularity, connections, expanded FROM crawl_nodes"
+            )
+        ]
+
+    def save_crawl_nodes(self, nodes):
+        """Salva (in una transazione) i nodi del crawl modificati, come restituiti da load_crawl()."""
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO crawl_nodes (artist_id, hop, popularity, connections, expanded) VALUES (?, ?, ?, ?, ?)",
+                [(artist_id, hop, popularity, connections, int(expanded))
+                 for artist_id, hop, popularity, connections, expanded in nodes],
+            )
+
+    def add_pending_artist(self, artist_id, releases=None):
+        """Registra un artista in lavorazione (con le sole release da scaricare, in modalita' refresh)."""
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO pending_artists (artist_id, releases, added_at) VALUES (?, ?, ?)",
+                (artist_id, json.dumps(releases) if releases is not None else None, time.time()),
+            )
+
+    def remove_pending_artist(self, artist_id):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM pending_artists WHERE artist_id = ?", (artist_id,))
+
+    def pending_artists(self):
+        """Artisti rimasti a meta' nell'esecuzione precedente, come (artist_id, release o None)."""
+        rows = self._connection().execute("SELECT artist_id, releases FROM pending_artists ORDER BY added_at")
+        return [(artist_id, json.loads(releases) if releases else None) for artist_id, releases in rows]
+
+    def schedule_retry(self, url, name, artist_id, status, max_attempts, backoff):
+        """
+        Registra un tentativo fallito di `url` e fissa il prossimo dopo
+        backoff * 2^(tentativi - 1) secondi. Oltre `max_attempts` tentativi la
+        traccia viene abbandonata: restituisce il numero di tentativi, o None
+        se e' stata abbandonata.
+        """
+        conn = self._connection()
+        with conn:
+            row = conn.execute("SELECT attempts FROM retries WHERE url = ?", (url,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            if attempts >= max_attempts:
+                conn.execute("DELETE FROM retries WHERE url = ?", (url,))
+                return None
+            conn.execute(
+                "INSERT OR REPLACE INTO retries (url, name, artist_id, attempts, next_attempt_at, last_status) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, name, artist_id, attempts, time.time() + backoff * 2 ** (attempts - 1), status),
+            )
+        return attempts
+
+    def remove_retries(self, urls):
+        conn = self._connection()
+        with conn:
+            conn.executemany("DELETE FROM retries WHERE url = ?", [(url,) for url in urls])
+
+    def due_retries(self, now=None, limit=None):
+        """Tracce da riprovare gia' scadute, come (url, nome, artist_id)."""
+        query = "SELECT url, name, artist_id FROM retries WHERE next_attempt_at <= ? ORDER BY next_attempt_at"
+        params = [now if now is not None else time.time()]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self._connection().execute(query, params).fetchall()
+
+    def next_retry_at(self):
+        """Istante del prossimo tentativo in programma, o None se la coda e' vuota."""
+        return self._connection().execute("SELECT MIN(next_attempt_at) FROM retries").fetchone()[0]
+
+    def retry_count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM retries").fetchone()[0]
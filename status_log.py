@@ -0,0 +1,54 @@
+import os
+import threading
+from collections import deque
+
+STATUS_LOG_SIZE = int(os.getenv("STATUS_LOG_SIZE", "500"))
+
+class StatusLog:
+    """
+    Buffer circolare dei messaggi di stato di un download.
+
+    Conserva solo gli ultimi `maxlen` messaggi, ognuno con un numero di
+    sequenza crescente: i client chiedono i messaggi successivi al proprio
+    cursore e ricevono solo le righe nuove. Se il cursore e' ormai uscito dal
+    buffer, ricevono le righe disponibili e `dropped` indica quante ne hanno perse.
+    """
+    def __init__(self, messages=(), maxlen=STATUS_LOG_SIZE):
+        self._buffer = deque(maxlen=maxlen)
+        self._next_seq = 1
+        self._changed = threading.Condition()
+        for message in messages:
+            self.append(message)
+
+    def append(self, message):
+        with self._changed:
+            self._buffer.append((self._next_seq, message))
+            self._next_seq += 1
+            self._changed.notify_all()
+
+    def notify(self):
+        """Sveglia chi e' in attesa (es. dopo un cambio di progresso senza nuove righe)."""
+        with self._changed:
+            self._changed.notify_all()
+
+    @property
+    def cursor(self):
+        """Numero di sequenza dell'ultimo messaggio scritto."""
+        return self._next_seq - 1
+
+    def since(self, cursor=0):
+        """Restituisce (messaggi dopo `cursor`, nuovo cursore, messaggi persi)."""
+        with self._changed:
+            messages = [message for seq, message in self._buffer if seq > cursor]
+            first_seq = self._buffer[0][0] if self._buffer else self._next_seq
+            dropped = max(0, first_seq - cursor - 1)
+            return messages, self._next_seq - 1, dropped
+
+    def wait(self, cursor, timeout=None):
+        """Attende finche' non ci sono messaggi dopo `cursor` o scade il timeout."""
+        with self._changed:
+            if self._next_seq - 1 <= cursor:
+                self._changed.wait(timeout)
+
+    def __len__(self):
+        return len(self._buffer)
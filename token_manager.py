@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import base64
+import threading
+import requests
+from http_cache import DATA_DIR
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Solo Windows: senza lock tra processi il file resta condiviso, ma piu' refresh sono possibili
+    fcntl = None
+
+AUTH_URL = os.getenv("SPOTIFY_AUTH_URL", "https://accounts.spotify.com/api/token")
+
+# Token condiviso tra app web e container discover ("" lo disabilita)
+TOKEN_PATH = os.getenv("SPOTIFY_TOKEN_PATH", os.path.join(DATA_DIR, "spotify_token.json"))
+# Secondi prima della scadenza in cui il token viene rinnovato in anticipo
+TOKEN_REFRESH_MARGIN = int(os.getenv("SPOTIFY_TOKEN_REFRESH_MARGIN", "300"))
+# Attesa prima di riprovare un rinnovo in background non riuscito
+TOKEN_RETRY_DELAY = 30
+# Le richieste usano il token fino a questi secondi dalla scadenza (tolleranza
+# su orologi e latenza); il rinnovo anticipato spetta solo al thread in background
+TOKEN_EXPIRY_SKEW = 30
+
+class TokenManager:
+    """
+    Token client-credentials di Spotify condiviso tra thread e processi.
+
+    Un solo rinnovo alla volta: i thread che trovano il token scaduto mentre
+    un altro lo sta rinnovando aspettano il suo risultato invece di chiederne
+    uno nuovo. Un thread in background lo rinnova `refresh_margin` secondi
+    prima della scadenza indicata da `expires_in`; le richieste continuano a
+    usare il token attuale fino a TOKEN_EXPIRY_SKEW secondi dalla scadenza,
+    anche se il rinnovo in background non riesce, quindi di norma non
+    aspettano mai. Il token viene scritto in `path`: un altro
+    processo con le stesse credenziali (app web e discover) lo riusa invece
+    di rinnovarlo a sua volta; un lock sul file evita rinnovi contemporanei.
+    """
+    def __init__(self, client_id, client_secret, session=None, path=TOKEN_PATH, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        # Callable che restituisce la requests.Session da usare per il rinnovo
+        self._session = session or requests.Session
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_at = 0
+        self._rejected = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _valid(self, token, expires_at, margin=TOKEN_EXPIRY_SKEW):
+        return token and token != self._rejected and time.time() < expires_at - margin
+
+    def get(self):
+        """Restituisce un token valido, rinnovandolo se serve; None se il rinnovo fallisce."""
+        token, expires_at = self.access_token, self.expires_at
+        if self._valid(token, expires_at):
+            return token
+        return self.refresh(stale=token)
+
+    def invalidate(self, token):
+        """Segnala un token rifiutato dall'API (401): la prossima get() ne ottiene un altro."""
+        with self._lock:
+            self._rejected = token
+            if self.access_token == token:
+                self.expires_at = 0
+
+    def refresh(self, stale=None, margin=TOKEN_EXPIRY_SKEW):
+        """
+        Rinnova il token. Se nel frattempo un altro thread (o processo) ha
+        gia' sostituito `stale` con uno valido per piu' di `margin` secondi,
+        restituisce quello senza chiamare l'API.
+        """
+        with self._lock:
+            if self.access_token != stale and self._valid(self.access_token, self.expires_at, margin):
+                return self.access_token
+            with self._file_lock():
+                shared = self._read_shared()
+                if shared and self._valid(*shared, margin):
+                    self.access_token, self.expires_at = shared
+                    metrics.TOKEN_REFRESHES.inc(result='condiviso')
+                else:
+                    self._request_token()
+            if self.access_token:
+                self._start_refresher()
+            return self.access_token
+
+    def _request_token(self):
+        auth_header = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode('utf-8')).decode('utf-8')
+        headers = {'Authorization': f'Basic {auth_header}'}
+        data = {'grant_type': 'client_credentials'}
+        try:
+            response = self._session().post(AUTH_URL, headers=headers, data=data, timeout=10)
+            response.raise_for_status()
+            token_info = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            metrics.TOKEN_REFRESHES.inc(result='errore')
+            print(f"ERRORE CRITICO: Impossibile ottenere il token da Spotify: {e}")
+            if time.time() >= self.expires_at or self.access_token == self._rejected:
+                self.access_token = None
+                self.expires_at = 0
+            return
+        self.access_token = token_info.get('access_token')
+        self.expires_at = time.time() + int(token_info.get('expires_in', 3600))
+        self._rejected = None
+        self._write_shared()
+        metrics.TOKEN_REFRESHES.inc(result='ok')
+        print(">>> Token Spotify rinnovato con successo. <<<")
+
+    def _start_refresher(self):
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name='spotify-token', daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        # Il rinnovo parte appena il token entra nel margine; dopo un rinnovo
+        # non riuscito si riprova tra TOKEN_RETRY_DELAY secondi, mentre le
+        # richieste continuano a usare il token attuale finche' e' valido
+        delay = self.expires_at - self.refresh_margin - time.time()
+        while not self._stop.wait(max(1, delay)):
+            if not self._valid(self.access_token, self.expires_at, self.refresh_margin):
+                self.refresh(stale=self.access_token, margin=self.refresh_margin)
+            if self._valid(self.access_token, self.expires_at, self.refresh_margin):
+                delay = self.expires_at - self.refresh_margin - time.time()
+            else:
+                delay = TOKEN_RETRY_DELAY
+
+    def close(self):
+        """Ferma il rinnovo in background."""
+        self._stop.set()
+
+    def _file_lock(self):
+        return _FileLock(self.path + '.lock' if self.path and fcntl else None)
+
+    def _read_shared(self):
+        if not self.path:
+            return None
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                shared = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if shared.get('client_id') != self.client_id:
+            return None
+        return shared.get('access_token'), shared.get('expires_at', 0)
+
+    def _write_shared(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            # Il token da' accesso all'API con le nostre credenziali: solo il proprietario lo legge
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'client_id': self.client_id,
+                    'access_token': self.access_token,
+                    'expires_at': self.expires_at,
+                }, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Impossibile salvare il token condiviso in {self.path}: {e}")
+
+class _FileLock:
+    """Lock esclusivo tra processi su `path` (nessun lock se path e' None)."""
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if self.path:
+            try:
+                self._file = open(self.path, 'a')
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            except OSError as e:
+                print(f"Lock del token non disponibile ({e}): proseguo senza.")
+                self._file = None
+        return self
+
+    def __exit__(self, *exc):
+        if self._file:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+        return False